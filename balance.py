@@ -0,0 +1,94 @@
+from collections import Counter, defaultdict
+
+class AnswerBalancer:
+    """
+    Decides whether to keep each question from its answer, so the answers of each question family
+      end up close to a target distribution instead of whatever the stories give, pass it to
+      countworld.generate_examples as balance
+
+    target (dict): {family: {answer: weight}} for each family, families not in target (or all
+                   families if target is None) aim for every answer being equally likely
+    min_supply (float): answers that are less than this fraction of the questions seen for a family are
+                        always kept, but are too rare to be balanced up to the target
+
+    Keeps a running count of the answers of the questions it is asked about (the supply) and keeps each
+      question with probability proportional to target / supply for its answer, scaled so the rarest
+      answer that isn't below min_supply is always kept. So common answers are thrown away just often
+      enough for the rarer ones to catch up, instead of over generating and throwing most examples away
+      afterwards
+    """
+
+    def __init__(self, target=None, min_supply=0.01):
+
+        assert 0 <= min_supply < 1
+
+        self.target = {}
+        if target is not None:
+            for family, weights in target.items():
+                total = sum(weights.values())
+                self.target[family] = {answer: weight / total for answer, weight in weights.items()}
+        self.min_supply = min_supply
+
+        #answers seen and kept for each family
+        self.supply = defaultdict(Counter)
+        self.supply_totals = Counter()
+        self.counts = defaultdict(Counter)
+        self.checked = 0
+        self.rejected = 0
+
+    def share(self, family, answer):
+        """
+        Fraction of the answers to family that should be answer
+        """
+
+        if family in self.target:
+            return self.target[family].get(answer, 0)
+        return 1 / len(self.supply[family])
+
+    def keep_probability(self, family, answer):
+
+        supply = self.supply[family]
+        total = self.supply_totals[family]
+
+        if supply[answer] < self.min_supply * total:
+            return 1
+
+        #target / supply of the rarest answer that is being balanced, which is always kept
+        balanced = [a for a in supply if supply[a] >= self.min_supply * total and self.share(family, a) > 0]
+        if len(balanced) == 0:
+            return 1
+        scale = min(supply[a] / self.share(family, a) for a in balanced)
+        return min(1, self.share(family, answer) / supply[answer] * scale)
+
+    def accept(self, family, answer, rng):
+        """
+        If a question of family with answer should be kept, only the answer is looked at
+        Each question should only be asked about once
+        """
+
+        self.checked += 1
+        self.supply[family][answer] += 1
+        self.supply_totals[family] += 1
+
+        keep = self.keep_probability(family, answer)
+        if keep >= 1 or rng.random() < keep:
+            return True
+
+        self.rejected += 1
+        return False
+
+    def add(self, family, answer):
+        """
+        Counts an answer that has been kept, only call for questions that end up in the dataset
+        """
+
+        self.counts[family][answer] += 1
+
+    def report(self):
+        """
+        Dict of the counts and the answer histogram of each family, for printing or saving
+        """
+
+        return {'checked': self.checked,
+                'rejected': self.rejected,
+                'histograms': {family: dict(sorted(counts.items())) for family, counts in sorted(self.counts.items())}}
@@ -0,0 +1,413 @@
+import numpy as np
+
+import countworld
+
+#action ids, NONE is used for stories that have already finished
+NONE, MOVE, PICK, DROP = -1, 0, 1, 2
+ACTIONS = ['move', 'pick', 'drop']
+
+class BatchWorld:
+    """
+    The state of a batch of stories held in numpy arrays, every story in the batch has space for
+      the maximum number of entities/objects/locations, but only uses its own number of them
+
+    position[B, E]: location of each entity, -1 before their first move
+    inventory[B, E, O]: how many of each object each entity is carrying
+    visits[B, L, E]: times each entity visited each location
+    picked_count/picked_sum[B, O, L, E]: times each object was picked up at each location by each entity, and how many in total
+    dropped_count/dropped_sum[B, O, L, E]: same for drops
+    """
+
+    def __init__(self, n_entities, n_objects, n_locations, max_entities, max_objects, max_locations, pick_max):
+
+        self.n_entities = n_entities
+        self.n_objects = n_objects
+        self.n_locations = n_locations
+        self.pick_max = pick_max
+
+        B, E, O, L = len(n_entities), max_entities, max_objects, max_locations
+        self.rows = np.arange(B)
+        self.position = np.full((B, E), -1)
+        self.inventory = np.zeros((B, E, O), dtype=np.int64)
+        self.visits = np.zeros((B, L, E), dtype=np.int64)
+        self.picked_count = np.zeros((B, O, L, E), dtype=np.int64)
+        self.picked_sum = np.zeros((B, O, L, E), dtype=np.int64)
+        self.dropped_count = np.zeros((B, O, L, E), dtype=np.int64)
+        self.dropped_sum = np.zeros((B, O, L, E), dtype=np.int64)
+
+    def step(self, rng, active):
+        """
+        Adds a sentence to every story where active is True, with the same rules as countworld.generate_story
+        Returns the (action, entity, location or object, number of objects, location of the entity before the action)
+          arrays of the sentences
+        """
+
+        rows = self.rows
+        u = rng.random((len(rows), 4))
+
+        #select entity at random
+        actor = (u[:, 0] * self.n_entities).astype(np.int64)
+        position = self.position[rows, actor]
+        carrying = self.inventory[rows, actor].sum(1)
+
+        #pick is always available, move needs another location to go to and drop needs something to drop
+        can_move = self.n_locations > 1
+        can_drop = carrying > 0
+        choice = (u[:, 1] * (1 + can_move + can_drop)).astype(np.int64)
+        action = np.where(can_move, choice, choice + 1)
+
+        #if it's position is none, needs to go somewhere before it can act
+        first = position < 0
+        action[first] = MOVE
+        action[~active] = NONE
+
+        target = np.zeros(len(rows), dtype=np.int64)
+        n = np.zeros(len(rows), dtype=np.int64)
+
+        #moves go to any location first, then any location other than the current one
+        move = action == MOVE
+        other = (u[:, 2] * (self.n_locations - 1)).astype(np.int64)
+        target[move] = np.where(first, (u[:, 2] * self.n_locations).astype(np.int64), other + (other >= position))[move]
+
+        #picks pick any object
+        pick = action == PICK
+        target[pick] = (u[:, 2] * self.n_objects).astype(np.int64)[pick]
+        n[pick] = 1 + (u[:, 3] * self.pick_max).astype(np.int64)[pick]
+
+        #drops drop one of the objects being carried
+        drop = action == DROP
+        held = self.inventory[rows, actor] > 0
+        nth_held = (u[:, 2] * held.sum(1)).astype(np.int64)
+        dropped = np.argmax(np.cumsum(held, 1) > nth_held[:, None], 1)
+        target[drop] = dropped[drop]
+        n[drop] = 1 + (u[:, 3] * self.inventory[rows, actor, dropped]).astype(np.int64)[drop]
+
+        #update the state, each row is only updated once so fancy indexing is safe
+        b = rows[move]
+        self.position[b, actor[b]] = target[b]
+        self.visits[b, target[b], actor[b]] += 1
+
+        b = rows[pick]
+        self.inventory[b, actor[b], target[b]] += n[b]
+        self.picked_count[b, target[b], position[b], actor[b]] += 1
+        self.picked_sum[b, target[b], position[b], actor[b]] += n[b]
+
+        b = rows[drop]
+        self.inventory[b, actor[b], target[b]] -= n[b]
+        self.dropped_count[b, target[b], position[b], actor[b]] += 1
+        self.dropped_sum[b, target[b], position[b], actor[b]] += n[b]
+
+        return action, actor, target, n, position
+
+    def answers(self, which_questions, inventory=None):
+        """
+        Answer to every question in which_questions for every story, as a [B, questions] array
+        The questions are in the order of countworld.AnswerTracker.questions for the maximum number
+          of entities/objects/locations, questions about ones a story doesn't have are 0
+        Uses the same answers as countworld for questions 8, 13 and 17
+        If given, inventory is used instead of the current inventory for question 1
+        """
+
+        rows = self.rows
+        if inventory is None:
+            inventory = self.inventory
+        last_object = self.n_objects - 1
+
+        picked_ol = self.picked_count.sum(3)
+        picked_oe = self.picked_count.sum(2)
+        dropped_ol = self.dropped_count.sum(3)
+        dropped_oe = self.dropped_count.sum(2)
+        n_locations = self.visits.shape[1]
+
+        families = {1: lambda: inventory,
+                    2: lambda: (picked_oe > 0).sum(2),
+                    3: lambda: picked_ol.sum(2),
+                    4: lambda: self.picked_sum.sum((2, 3)),
+                    5: lambda: (dropped_oe > 0).sum(2),
+                    6: lambda: dropped_ol.sum(2),
+                    7: lambda: self.dropped_sum.sum((2, 3)),
+                    8: lambda: np.repeat((picked_ol[rows, last_object] > 0).sum(1)[:, None], n_locations, 1),
+                    9: lambda: picked_ol,
+                    10: lambda: self.picked_sum.sum(3),
+                    11: lambda: picked_oe,
+                    12: lambda: self.picked_sum.sum(2),
+                    13: lambda: np.repeat((dropped_ol[rows, last_object] > 0).sum(1)[:, None], n_locations, 1),
+                    14: lambda: dropped_ol,
+                    15: lambda: self.dropped_sum.sum(3),
+                    16: lambda: dropped_oe,
+                    17: lambda: dropped_oe,
+                    18: lambda: (self.visits > 0).sum(2),
+                    19: lambda: self.visits.transpose(0, 2, 1),
+                    20: lambda: self.visits.sum(2)}
+
+        return np.concatenate([families[f]().reshape(len(rows), -1) for f in sorted(which_questions)], 1)
+
+def generate_batch(batch_size,
+                   n_entities,
+                   n_objects,
+                   n_locations,
+                   story_length,
+                   n_questions,
+                   which_questions,
+                   answer_values,
+                   supporting_answers,
+                   pick_max,
+                   rng,
+                   names,
+                   structured=False):
+    """
+    Generates a batch of batch_size stories at once, see countworld.iter_examples for the arguments
+    rng is a numpy random Generator and names is a tuple of the (entity, object, location) name lists
+
+    Returns the examples that have enough questions with answers within answer_values, the rest are thrown away,
+      and the row of the batch each example is from
+    """
+
+    B = batch_size
+    rows = np.arange(B)
+    entity_names, object_names, location_names = [np.array(n) for n in names]
+
+    #selecting the amount of entities/objects/locations/questions/story length for each example
+    example_n_entities = rng.integers(n_entities[0], n_entities[1], B, endpoint=True)
+    example_n_objects = rng.integers(n_objects[0], n_objects[1], B, endpoint=True)
+    example_n_locations = rng.integers(n_locations[0], n_locations[1], B, endpoint=True)
+    example_n_questions = rng.integers(n_questions[0], n_questions[1], B, endpoint=True)
+    example_story_length = rng.integers(story_length[0], story_length[1], B, endpoint=True)
+
+    #random names for each story
+    entity_ids = np.argsort(rng.random((B, len(entity_names))), 1)[:, :n_entities[1]]
+    object_ids = np.argsort(rng.random((B, len(object_names))), 1)[:, :n_objects[1]]
+    location_ids = np.argsort(rng.random((B, len(location_names))), 1)[:, :n_locations[1]]
+
+    #every question for the maximum number of entities/objects/locations and which stories have what they ask about
+    catalogue = countworld.AnswerTracker(range(n_entities[1]), range(n_objects[1]), range(n_locations[1])).questions(which_questions)
+    question_ids = np.array([[-1 if i is None else i for i in q] for q in catalogue])
+    valid = ((question_ids[:, 1] < example_n_entities[:, None])
+             & (question_ids[:, 2] < example_n_objects[:, None])
+             & (question_ids[:, 3] < example_n_locations[:, None]))
+
+    #generate stories, every answer except for question 1 never goes down, so the range of the answers over
+    #the story is from the answer after the first sentence to the final answer, for question 1 the smallest
+    #is always 0 (as the first sentence is always a move) so we only need to keep the most being carried
+    world = BatchWorld(example_n_entities, example_n_objects, example_n_locations, n_entities[1], n_objects[1], n_locations[1], pick_max)
+    story = np.zeros((5, story_length[1], B), dtype=np.int64)
+    most_carried = np.zeros_like(world.inventory)
+
+    for t in range(story_length[1]):
+        story[:, t] = world.step(rng, t < example_story_length)
+        if supporting_answers:
+            np.maximum(most_carried, world.inventory, out=most_carried)
+            if t == 0:
+                first_answers = world.answers(which_questions)
+
+    final_answers = world.answers(which_questions)
+
+    #only keep questions with answers within the specified range
+    if supporting_answers:
+        highest_answers = world.answers(which_questions, most_carried)
+        keep = valid & (first_answers >= answer_values[0]) & (highest_answers <= answer_values[1])
+    else:
+        keep = valid & (final_answers >= answer_values[0]) & (final_answers <= answer_values[1])
+
+    #randomly pick n questions for each story from the ones we keep
+    accepted = keep.sum(1) >= example_n_questions
+    order = np.argsort(np.where(keep, rng.random(keep.shape), 2), 1)[:, :n_questions[1]]
+
+    if supporting_answers:
+        answers = answer_series(story, question_ids[order], example_n_objects, n_entities[1], n_locations[1], which_questions).tolist()
+    else:
+        answers = final_answers[rows[:, None], order].tolist()
+
+    #turn arrays into examples, converting whole arrays to lists at once as it's much faster than per story
+    actions, actors, targets, amounts = story[:4].transpose(0, 2, 1).tolist()
+    all_entities = entity_names[entity_ids].tolist()
+    all_objects = object_names[object_ids].tolist()
+    all_locations = location_names[location_ids].tolist()
+    all_order = order.tolist()
+    lengths = example_story_length.tolist()
+    question_counts = example_n_questions.tolist()
+
+    examples = []
+    accepted_rows = np.nonzero(accepted)[0].tolist()
+    for b in accepted_rows:
+
+        entities, objects, locations = all_entities[b], all_objects[b], all_locations[b]
+        length = lengths[b]
+
+        if structured:
+            example_story = [(ACTIONS[action], entities[actor], locations[target] if action == MOVE else objects[target], n)
+                             for action, actor, target, n in zip(actions[b][:length], actors[b], targets[b], amounts[b])]
+        else:
+            example_story = [f'{entities[actor]} went to the {locations[target]}' if action == MOVE else
+                             f'{entities[actor]} picked up {n} {objects[target]}' if action == PICK else
+                             f'{entities[actor]} dropped {n} {objects[target]}'
+                             for action, actor, target, n in zip(actions[b][:length], actors[b], targets[b], amounts[b])]
+
+        questions = []
+        for q, a in zip(all_order[b][:question_counts[b]], answers[b]):
+            family, e, o, l = catalogue[q]
+            question = (family,
+                        None if e is None else entities[e],
+                        None if o is None else objects[o],
+                        None if l is None else locations[l])
+            if not structured:
+                question = countworld.QUESTION_TEMPLATES[family].format(entity=question[1], object=question[2], location=question[3])
+            if supporting_answers:
+                a = a[:length]
+            questions.append((question, a))
+
+        examples.append({'story': example_story, 'questions': questions})
+
+    return examples, accepted_rows
+
+def answer_series(story, questions, n_objects, max_entities, max_locations, which_questions):
+    """
+    Answer at each step of the story for the given questions, worked out from the sentences
+      instead of replaying the story
+
+    story is the [5, T, B] array of sentences from BatchWorld.step
+    questions is a [B, n, 4] array of (family, entity, object, location) for each story
+    Returns a [B, n, T] array
+    """
+
+    action, actor, target, n, position = [a.T[:, None, :] for a in story]
+    family, entity, obj, location = [questions[:, :, i, None] for i in range(4)]
+    last_object = (n_objects - 1)[:, None, None]
+
+    move = action == MOVE
+    picked = (action == PICK) & (target == obj)
+    dropped = (action == DROP) & (target == obj)
+    by_entity = actor == entity
+    at_location = position == location
+    to_location = move & (target == location)
+
+    def distinct(events, keys, n_keys):
+        #number of different keys the events have happened with so far
+        return sum(np.logical_or.accumulate(events & (keys == k), -1) for k in range(n_keys))
+
+    #answers are how many times something happened (or how many of an object) so far,
+    #or how many different entities/locations something happened with so far
+    families = {1: lambda: np.cumsum((picked & by_entity) * n - (dropped & by_entity) * n, -1),
+                2: lambda: distinct(picked, actor, max_entities),
+                3: lambda: np.cumsum(picked, -1),
+                4: lambda: np.cumsum(picked * n, -1),
+                5: lambda: distinct(dropped, actor, max_entities),
+                6: lambda: np.cumsum(dropped, -1),
+                7: lambda: np.cumsum(dropped * n, -1),
+                8: lambda: distinct((action == PICK) & (target == last_object), position, max_locations),
+                9: lambda: np.cumsum(picked & at_location, -1),
+                10: lambda: np.cumsum((picked & at_location) * n, -1),
+                11: lambda: np.cumsum(picked & by_entity, -1),
+                12: lambda: np.cumsum((picked & by_entity) * n, -1),
+                13: lambda: distinct((action == DROP) & (target == last_object), position, max_locations),
+                14: lambda: np.cumsum(dropped & at_location, -1),
+                15: lambda: np.cumsum((dropped & at_location) * n, -1),
+                16: lambda: np.cumsum(dropped & by_entity, -1),
+                17: lambda: np.cumsum(dropped & by_entity, -1),
+                18: lambda: distinct(to_location, actor, max_entities),
+                19: lambda: np.cumsum(to_location & by_entity, -1),
+                20: lambda: np.cumsum(to_location, -1)}
+
+    series = np.zeros(questions.shape[:2] + (story.shape[1],), dtype=np.int64)
+    for f in which_questions:
+        series = np.where(family == f, families[f](), series)
+    return series
+
+def iter_examples(n_examples,
+                  n_entities,
+                  n_objects,
+                  n_locations,
+                  story_length,
+                  n_questions,
+                  which_questions,
+                  answer_values,
+                  supporting_answers,
+                  pick_max,
+                  random_seed=None,
+                  batch_size=1024,
+                  stats=None,
+                  structured=False,
+                  max_attempts=1000):
+    """
+    Same as countworld.iter_examples, but simulates batch_size stories at once with numpy arrays
+
+    Stories follow the same rules and questions have the same answers as countworld, but use
+      numpy's random numbers, so are different for the same random_seed
+    Stories without enough questions with answers within answer_values are thrown away and
+      counted as rejected in stats, if max_attempts stories in a row are thrown away a ValueError is raised,
+      the same as countworld after max_attempts attempts at an example
+    """
+
+    assert n_entities[0] <= n_entities[1]
+    assert n_objects[0] <= n_objects[1]
+    assert n_locations[0] <= n_locations[1]
+    assert n_questions[0] <= n_questions[1]
+    assert story_length[0] <= story_length[1]
+    assert answer_values[0] <= answer_values[1]
+    assert n_entities[0] > 0
+    assert n_locations[0] > 0
+    assert n_objects[0] > 0
+    assert story_length[0] > 0
+    assert n_questions[0] > 0
+    assert len(which_questions) > 0
+    assert n_entities[1] <= len(countworld.ENTITY_NAMES)
+    assert n_objects[1] <= len(countworld.OBJECT_NAMES)
+    assert n_locations[1] <= len(countworld.LOCATION_NAMES)
+    assert pick_max > 0
+    assert batch_size > 0
+    assert max_attempts > 0
+
+    rng = np.random.default_rng(random_seed)
+
+    #countworld shuffles its name lists in place, so sort them to not depend on what has already been generated
+    names = (sorted(countworld.ENTITY_NAMES), sorted(countworld.OBJECT_NAMES), sorted(countworld.LOCATION_NAMES))
+
+    generated = 0
+    #stories thrown away since the last one that was kept
+    failed = 0
+
+    def reject(n):
+        """
+        Counts n more stories thrown away in a row, raising once there have been max_attempts
+        """
+
+        nonlocal failed
+        n = min(n, max_attempts - failed)
+        failed += n
+        if stats is not None:
+            stats['attempts'] += n
+            stats['rejected'] += n
+        if failed >= max_attempts:
+            raise ValueError(f'could not generate an example with enough questions with answers in {answer_values} after {max_attempts} attempts')
+
+    while generated < n_examples:
+
+        examples, rows = generate_batch(batch_size,
+                                        n_entities,
+                                        n_objects,
+                                        n_locations,
+                                        story_length,
+                                        n_questions,
+                                        which_questions,
+                                        answer_values,
+                                        supporting_answers,
+                                        pick_max,
+                                        rng,
+                                        names,
+                                        structured)
+
+        #stories are counted in the order of the batch, as if they were generated one at a time, so the
+        #stories after the last example that is used aren't counted
+        previous = -1
+        for example, row in zip(examples[:n_examples - generated], rows):
+            reject(row - previous - 1)
+            previous = row
+            failed = 0
+            if stats is not None:
+                stats['attempts'] += 1
+                stats['examples'] += 1
+            generated += 1
+            yield example
+
+        if generated < n_examples:
+            reject(batch_size - previous - 1)
@@ -0,0 +1,172 @@
+import countworld
+import argparse
+import itertools
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+def parse_list(s, type=int):
+    return [type(x) for x in s.split(',')]
+
+parser = argparse.ArgumentParser(description='Benchmark countworld generation', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--n_examples', default=500, type=int, help='Number of examples generated for each benchmark')
+parser.add_argument('--story_lengths', default='10,50', type=str, help='Story lengths to benchmark')
+parser.add_argument('--n_entities', default='2,5', type=str, help='Numbers of entities to benchmark')
+parser.add_argument('--n_objects', default='2,5', type=str, help='Numbers of objects to benchmark')
+parser.add_argument('--n_locations', default='2,5', type=str, help='Numbers of locations to benchmark')
+parser.add_argument('--which_questions', default='1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20;1,19', type=str, help='Sets of questions to benchmark, separated by ;')
+parser.add_argument('--supporting_answers', default='0,1', type=str, help='Supporting answers settings to benchmark, 0 is off and 1 is on')
+parser.add_argument('--pick_max', default=3, type=int, help='Maximum number of objects an entity picks up during a pick action')
+parser.add_argument('--seed', default=1234, type=int, help='Random seed for generation')
+parser.add_argument('--output', default='bench.json', type=str, help='File the results are saved to as JSON')
+parser.add_argument('--baseline', default=None, type=str, help='Results from a previous run to compare against')
+parser.add_argument('--tolerance', default=0.1, type=float, help='Fraction slower than the baseline a benchmark can be before it is flagged')
+
+#parameters that identify a benchmark, used to match benchmarks to the baseline
+KEYS = ['story_length', 'n_entities', 'n_objects', 'n_locations', 'which_questions', 'supporting_answers']
+
+def peak_rss():
+    """
+    Peak resident memory of this process in MB
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is bytes on macos and kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return peak / 2**20
+    return peak / 2**10
+
+def run_benchmark(config):
+    """
+    Times each phase of generation for a single config, a dict with a value for each of KEYS
+      plus n_examples, pick_max and seed
+    Each phase is run on its own:
+    - generate_examples: generating the examples, as generate.py does
+    - generate_story: only the stories, without picking questions
+    - generate_questions: the answer to every question for each of those stories, using generate_questions
+    - examples_to_file: writing the generated examples to a file
+    Returns the config with the timings added, should be run in a fresh process so peak_rss is only for this config
+    """
+
+    n_examples = config['n_examples']
+    story_length = config['story_length']
+    n_entities, n_objects, n_locations = config['n_entities'], config['n_objects'], config['n_locations']
+    which_questions = set(config['which_questions'])
+    phases = {}
+
+    start = time.perf_counter()
+    examples = countworld.generate_examples(n_examples,
+                                            (n_entities, n_entities),
+                                            (n_objects, n_objects),
+                                            (n_locations, n_locations),
+                                            (story_length, story_length),
+                                            (1, 1),
+                                            which_questions,
+                                            (-float('inf'), float('inf')),
+                                            config['supporting_answers'],
+                                            config['pick_max'],
+                                            rng=random.Random(config['seed']),
+                                            progress=False)
+    phases['generate_examples'] = time.perf_counter() - start
+
+    rng = random.Random(config['seed'])
+    trackers = []
+    start = time.perf_counter()
+    for _ in range(n_examples):
+        entities = [countworld.Entity(i, countworld.ENTITY_NAMES[i]) for i in range(n_entities)]
+        objects = [countworld.Object(i, countworld.OBJECT_NAMES[i]) for i in range(n_objects)]
+        locations = [countworld.Location(i, countworld.LOCATION_NAMES[i]) for i in range(n_locations)]
+        tracker = countworld.AnswerTracker(countworld.ENTITY_NAMES[:n_entities],
+                                           countworld.OBJECT_NAMES[:n_objects],
+                                           countworld.LOCATION_NAMES[:n_locations])
+        story = []
+        for _ in range(story_length):
+            countworld.generate_story(story, entities, objects, locations, config['pick_max'], tracker, rng)
+        trackers.append(tracker)
+    phases['generate_story'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for tracker in trackers:
+        countworld.generate_questions(defaultdict(list), tracker, which_questions)
+    phases['generate_questions'] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        countworld.examples_to_file('bench', examples, data_dir=data_dir)
+        phases['examples_to_file'] = time.perf_counter() - start
+
+    result = dict(config)
+    result['phases'] = phases
+    result['examples_per_sec'] = n_examples / phases['generate_examples']
+    result['sentences_per_sec'] = n_examples * story_length / phases['generate_examples']
+    result['peak_rss_mb'] = peak_rss()
+    return result
+
+def key(result):
+    return tuple(str(result[k]) for k in KEYS)
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of (result, baseline result) for every result that generates examples
+      more than tolerance slower than the same benchmark in the baseline
+    """
+
+    baseline = {key(b): b for b in baseline['results']}
+    regressions = []
+    for result in results:
+        b = baseline.get(key(result))
+        if b is not None and result['examples_per_sec'] < b['examples_per_sec'] * (1 - tolerance):
+            regressions.append((result, b))
+    return regressions
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    configs = []
+    for story_length, n_entities, n_objects, n_locations, which_questions, supporting_answers in itertools.product(
+            parse_list(args.story_lengths),
+            parse_list(args.n_entities),
+            parse_list(args.n_objects),
+            parse_list(args.n_locations),
+            [parse_list(q) for q in args.which_questions.split(';')],
+            parse_list(args.supporting_answers)):
+        configs.append({'n_examples': args.n_examples,
+                        'story_length': story_length,
+                        'n_entities': n_entities,
+                        'n_objects': n_objects,
+                        'n_locations': n_locations,
+                        'which_questions': sorted(which_questions),
+                        'supporting_answers': bool(supporting_answers),
+                        'pick_max': args.pick_max,
+                        'seed': args.seed})
+
+    #each benchmark runs in a new process so the peak memory of one doesn't hide the others
+    results = []
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_benchmark, configs):
+            phases = ' '.join(f'{phase} {t:.3f}s' for phase, t in result['phases'].items())
+            print(' '.join(f'{k}={result[k]}' for k in KEYS if k != 'which_questions'),
+                  f"questions={len(result['which_questions'])}",
+                  f"| {result['examples_per_sec']:.0f} examples/s {result['sentences_per_sec']:.0f} sentences/s",
+                  f"{result['peak_rss_mb']:.0f}MB | {phases}")
+            results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': sys.version, 'results': results}, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for result, b in regressions:
+            print('REGRESSION', ' '.join(f'{k}={result[k]}' for k in KEYS),
+                  f"{result['examples_per_sec']:.0f} examples/s, was {b['examples_per_sec']:.0f}")
+        print(f'{len(regressions)} of {len(results)} benchmarks more than {args.tolerance:.0%} slower than {args.baseline}')
+        if len(regressions) > 0:
+            sys.exit(1)
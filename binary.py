@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import mmap
+import shutil
+import struct
+import tempfile
+from array import array
+
+import countworld
+from vocab import Vocab
+
+#first bytes of every binary file
+MAGIC = b'CWB1'
+
+#actions in the order of their ids
+ACTIONS = countworld.ACTIONS
+
+#(name, typecode) of each column, all columns are flat arrays
+# sentences: 4 ints per sentence, (action, entity, location or object, number of objects)
+# questions: 4 ints per question, (question family, entity, object, location) with -1 for unused slots
+# answers: every answer, one per question or one per sentence for each question with supporting answers
+# *_offsets: where each example (or question for answers) starts and ends, in rows of the column
+#the typecodes are what is used while writing, see INT_TYPECODES for what is used in the file
+COLUMNS = [('sentences', 'i'),
+           ('story_offsets', 'q'),
+           ('questions', 'i'),
+           ('question_offsets', 'q'),
+           ('answers', 'i'),
+           ('answer_offsets', 'q')]
+
+#number of ints per row of each column
+ROW_SIZES = {'sentences': 4, 'questions': 4}
+
+#columns are stored with the smallest of these typecodes their values fit in
+INT_TYPECODES = [('b', -2**7, 2**7-1), ('h', -2**15, 2**15-1), ('i', -2**31, 2**31-1), ('q', -2**63, 2**63-1)]
+
+class BinaryWriter:
+    """
+    Writes examples generated with structured=True to a single binary file, see COLUMNS for what is stored
+
+    Each column is written to its own temporary file as examples are written, these are put together
+      with a header holding the vocab and where each column is when the writer is closed,
+      so memory doesn't depend on the number of examples
+
+    The ids of the names are from vocab (a vocab.Vocab, the built in names if not given), so every file
+      written with the same vocab uses the same ids, and only its names are stored in the header
+
+    Used as a context manager or by calling close when done
+    """
+
+    def __init__(self, path, buffer_size=1<<16, vocab=None):
+
+        self.path = path
+        self.vocab = Vocab() if vocab is None else vocab
+        self.buffer_size = buffer_size
+        self.buffers = {name: array(typecode) for name, typecode in COLUMNS}
+        self.files = {name: tempfile.TemporaryFile(dir=os.path.dirname(path) or '.') for name, _ in COLUMNS}
+        self.lengths = {name: 0 for name, _ in COLUMNS}
+        self.ranges = {name: (0, 0) for name, _ in COLUMNS}
+        self.n_examples = 0
+        self.supporting_answers = False
+
+        #offsets start at 0
+        self.buffers['story_offsets'].append(0)
+        self.buffers['question_offsets'].append(0)
+        self.buffers['answer_offsets'].append(0)
+        self.totals = {'sentences': 0, 'questions': 0, 'answers': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        #a failed write leaves path as it was instead of replacing it with part of the examples
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, example):
+
+        rows = self.vocab.rows(example)
+
+        sentences = self.buffers['sentences']
+        for row in rows['story']:
+            sentences.extend(row)
+        self.totals['sentences'] += len(rows['story'])
+        self.buffers['story_offsets'].append(self.totals['sentences'])
+
+        questions = self.buffers['questions']
+        answers = self.buffers['answers']
+        for row, answer in zip(rows['questions'], rows['answers']):
+            questions.extend(row)
+            if isinstance(answer, list):
+                self.supporting_answers = True
+                answers.extend(answer)
+                self.totals['answers'] += len(answer)
+            else:
+                answers.append(answer)
+                self.totals['answers'] += 1
+            self.buffers['answer_offsets'].append(self.totals['answers'])
+        self.totals['questions'] += len(example['questions'])
+        self.buffers['question_offsets'].append(self.totals['questions'])
+
+        self.n_examples += 1
+
+        if len(sentences) + len(answers) > self.buffer_size:
+            self.flush()
+
+    def flush(self):
+
+        for name, buffer in self.buffers.items():
+            if len(buffer) > 0:
+                low, high = self.ranges[name]
+                self.ranges[name] = (min(low, min(buffer)), max(high, max(buffer)))
+            buffer.tofile(self.files[name])
+            self.lengths[name] += len(buffer)
+            del buffer[:]
+
+    def typecode(self, name):
+        """
+        Typecode the column is stored with in the file, the smallest one its values fit in
+        """
+
+        low, high = self.ranges[name]
+        return next(t for t, t_low, t_high in INT_TYPECODES if t_low <= low and high <= t_high)
+
+    def close(self):
+        """
+        Writes the file to a temporary file, which then replaces path, so path never has part of the examples
+        """
+
+        if self.files is None:
+            return
+
+        try:
+            self.write_file(self.path + '.tmp')
+        except BaseException:
+            self.abort()
+            raise
+        self.files = None
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        """
+        Throws away the examples written so far, leaving path as it was
+        """
+
+        if self.files is not None:
+            for column in self.files.values():
+                column.close()
+            self.files = None
+        if os.path.exists(self.path + '.tmp'):
+            os.remove(self.path + '.tmp')
+
+    def write_file(self, path):
+
+        self.flush()
+
+        #columns start 8 byte aligned after the header, offsets are from the start of the file
+        header = {'n_examples': self.n_examples,
+                  'byteorder': sys.byteorder,
+                  'supporting_answers': self.supporting_answers,
+                  'actions': ACTIONS,
+                  'vocab': self.vocab.names,
+                  'question_templates': countworld.QUESTION_TEMPLATES,
+                  'columns': {}}
+
+        #header size depends on the offsets in it, so leave space for the offsets to be any size
+        offset = 0
+        for name, _ in COLUMNS:
+            typecode = self.typecode(name)
+            header['columns'][name] = [typecode, offset, self.lengths[name]]
+            offset += aligned(self.lengths[name] * array(typecode).itemsize)
+        data_start = aligned(len(MAGIC) + 8 + len(json.dumps(header)) + 20 * len(COLUMNS))
+        for name, _ in COLUMNS:
+            header['columns'][name][1] += data_start
+        header_bytes = json.dumps(header).encode()
+        assert len(MAGIC) + 8 + len(header_bytes) <= data_start
+        header_bytes += b' ' * (data_start - len(MAGIC) - 8 - len(header_bytes))
+
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for name, typecode in COLUMNS:
+                column = self.files[name]
+                column.seek(0)
+                size = 0
+                if self.typecode(name) == typecode:
+                    shutil.copyfileobj(column, f)
+                    size = column.tell()
+                else:
+                    #copy in chunks, narrowing to the smaller typecode
+                    while True:
+                        chunk = column.read(self.buffer_size * array(typecode).itemsize)
+                        if len(chunk) == 0:
+                            break
+                        narrowed = array(self.typecode(name), array(typecode, chunk))
+                        narrowed.tofile(f)
+                        size += len(narrowed) * narrowed.itemsize
+                f.write(b'\0' * (aligned(size) - size))
+                column.close()
+
+class BinaryDataset:
+    """
+    Reads a file written by BinaryWriter by memory mapping it, nothing is read until it is used
+
+    dataset[i] gives example i as a dict of memoryviews into the file, with no copying:
+      'story' is a (sentences, 4) view, 'questions' is a (questions, 4) view and 'answers'
+      is a list of views with the answers to each question
+    dataset.decode(i) gives example i with strings, the same as generate_examples
+    """
+
+    def __init__(self, path):
+
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        assert self.mmap[:len(MAGIC)] == MAGIC, f'{path} is not a countworld binary file'
+        header_length, = struct.unpack('<Q', self.mmap[len(MAGIC):len(MAGIC)+8])
+        self.header = json.loads(self.mmap[len(MAGIC)+8:len(MAGIC)+8+header_length])
+        assert self.header['byteorder'] == sys.byteorder, f'{path} was written with {self.header["byteorder"]} endian ints'
+
+        self.vocab = self.header['vocab']
+        self.supporting_answers = self.header['supporting_answers']
+        self.actions = self.header['actions']
+        self.question_templates = {int(k): v for k, v in self.header['question_templates'].items()}
+
+        view = memoryview(self.mmap)
+        self.columns = {}
+        for name, (typecode, offset, length) in self.header['columns'].items():
+            self.columns[name] = view[offset:offset + length * array(typecode).itemsize]
+
+        self.typecodes = {name: typecode for name, (typecode, _, _) in self.header['columns'].items()}
+        self.story_offsets = self.columns['story_offsets'].cast(self.typecodes['story_offsets'])
+        self.question_offsets = self.columns['question_offsets'].cast(self.typecodes['question_offsets'])
+        self.answer_offsets = self.columns['answer_offsets'].cast(self.typecodes['answer_offsets'])
+        self.answers = self.columns['answers'].cast(self.typecodes['answers'])
+
+    def __len__(self):
+        return self.header['n_examples']
+
+    def rows(self, name, start, end):
+        """
+        Rows start to end of the sentences/questions column as a (rows, 4) view
+        """
+
+        typecode = self.typecodes[name]
+        row_bytes = ROW_SIZES[name] * array(typecode).itemsize
+        return self.columns[name][start * row_bytes:end * row_bytes].cast(typecode, [end - start, ROW_SIZES[name]])
+
+    def __getitem__(self, i):
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        story = self.rows('sentences', self.story_offsets[i], self.story_offsets[i+1])
+        start, end = self.question_offsets[i], self.question_offsets[i+1]
+        questions = self.rows('questions', start, end)
+        answers = [self.answers[self.answer_offsets[q]:self.answer_offsets[q+1]] for q in range(start, end)]
+        return {'story': story, 'questions': questions, 'answers': answers}
+
+    def decode(self, i):
+
+        example = self[i]
+        entities, objects, locations = self.vocab['entities'], self.vocab['objects'], self.vocab['locations']
+
+        story = []
+        for action, entity, target, n in example['story'].tolist():
+            action = self.actions[action]
+            target = locations[target] if action == 'move' else objects[target]
+            story.append(countworld.SENTENCE_TEMPLATES[action].format(entity=entities[entity], target=target, n=n))
+
+        questions = []
+        for (family, entity, obj, location), answer in zip(example['questions'].tolist(), example['answers']):
+            question = self.question_templates[family].format(entity=entities[entity] if entity >= 0 else None,
+                                                              object=objects[obj] if obj >= 0 else None,
+                                                              location=locations[location] if location >= 0 else None)
+            answer = answer.tolist()
+            questions.append((question, answer if self.supporting_answers else answer[0]))
+
+        return {'story': story, 'questions': questions}
+
+    def close(self):
+        """
+        Views from dataset[i] have to be released before closing
+        """
+
+        self.columns = self.story_offsets = self.question_offsets = self.answer_offsets = self.answers = None
+        self.mmap.close()
+        self.file.close()
+
+def aligned(n, alignment=8):
+    return (n + alignment - 1) // alignment * alignment
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import countworld
+import loader
+
+def config_key(config):
+    """
+    Hash of everything that changes the examples generated, config should be a dict of the
+      arguments but not the number of examples in each split, so a run with more examples
+      has the same key and its examples can be reused
+    """
+
+    config = json.dumps({'config': config, 'version': countworld.GENERATOR_VERSION}, sort_keys=True)
+    return hashlib.sha256(config.encode()).hexdigest()
+
+def link_or_copy(source, destination):
+    """
+    Hard links source to destination, replacing destination, or copies it if it can't be hard linked
+    """
+
+    #renaming a hard link over another link to the same file does nothing, leaving the temporary link behind
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    if os.path.exists(destination + '.tmp'):
+        os.remove(destination + '.tmp')
+    try:
+        os.link(source, destination + '.tmp')
+    except OSError:
+        shutil.copyfile(source, destination + '.tmp')
+    os.replace(destination + '.tmp', destination)
+
+class DatasetCache:
+    """
+    Directory of previously generated splits, each in its own directory named by the config_key of the
+      arguments used to generate them, with a meta.json holding the arguments, the number of examples
+      in each split and when it was last used
+
+    The splits are one stream of examples split in order, so any run with the same config_key and
+      at most as many examples in total can be served from a cached run by taking the examples it
+      needs from the start of the stream, e.g. 10k train examples from a run with 100k. When the
+      number of examples in each split is the same the files are hard linked instead of copied
+
+    When the cache is bigger than max_bytes, the least recently used runs are removed
+    """
+
+    def __init__(self, root, max_bytes=10 * 2**30):
+
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def meta(self, key):
+        """
+        The meta.json of the cached run for key, or None if there isn't one
+        """
+
+        try:
+            with open(os.path.join(self.entry_path(key), 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_meta(self, key, meta):
+
+        path = os.path.join(self.entry_path(key), 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def serve(self, key, splits, data_dir='data'):
+        """
+        Writes the splits, a list of (name, number of examples), to {data_dir}/{name}.txt from the cache
+        Returns False if there is no cached run for key with enough examples
+        """
+
+        meta = self.meta(key)
+        if meta is None or sum(meta['splits'].values()) < sum(n for _, n in splits):
+            return False
+
+        os.makedirs(data_dir, exist_ok=True)
+        entry = self.entry_path(key)
+
+        if [(name, meta['splits'].get(name)) for name, _ in splits] == splits:
+            for name, _ in splits:
+                link_or_copy(os.path.join(entry, f'{name}.txt'), os.path.join(data_dir, f'{name}.txt'))
+        else:
+            #(path, offsets of each example) of the cached splits, in the order they were generated
+            sources = [(os.path.join(entry, f'{name}.txt'), loader.load_index(os.path.join(entry, f'{name}.txt'))[0])
+                       for name in meta['order']]
+            start = 0
+            for name, n_examples in splits:
+                path = os.path.join(data_dir, f'{name}.txt')
+                with open(path + '.tmp', 'wb') as f:
+                    self.copy_examples(sources, start, n_examples, f)
+                os.replace(path + '.tmp', path)
+                start += n_examples
+
+        meta['last_used'] = time.time()
+        self.write_meta(key, meta)
+        return True
+
+    def copy_examples(self, sources, start, n_examples, f):
+        """
+        Copies n_examples examples to f, starting from example start of the stream of examples in sources
+        """
+
+        for path, offsets in sources:
+
+            n_source = len(offsets) - 1
+            if start >= n_source:
+                start -= n_source
+                continue
+
+            end = min(start + n_examples, n_source)
+            with open(path, 'rb') as source:
+                source.seek(offsets[start])
+                remaining = offsets[end] - offsets[start]
+                while remaining > 0:
+                    chunk = source.read(min(remaining, 1 << 20))
+                    assert len(chunk) > 0, f'{path} is shorter than its index'
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+            n_examples -= end - start
+            start = 0
+            if n_examples == 0:
+                break
+
+    def store(self, key, config, splits, data_dir='data'):
+        """
+        Adds the splits just generated in {data_dir}, replacing any smaller cached run for key,
+          then removes least recently used runs until the cache fits in max_bytes
+        """
+
+        meta = self.meta(key)
+        if meta is not None and sum(meta['splits'].values()) >= sum(n for _, n in splits):
+            return
+
+        #put together somewhere else first, so a partly stored run is never used
+        entry = self.entry_path(key)
+        tmp = f'{entry}.tmp-{os.getpid()}'
+        os.makedirs(tmp)
+        for name, _ in splits:
+            link_or_copy(os.path.join(data_dir, f'{name}.txt'), os.path.join(tmp, f'{name}.txt'))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'config': config,
+                       'version': countworld.GENERATOR_VERSION,
+                       'splits': dict(splits),
+                       'order': [name for name, _ in splits],
+                       'last_used': time.time()}, f)
+
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.replace(tmp, entry)
+
+        self.evict(keep=key)
+
+    def size(self, key):
+
+        entry = self.entry_path(key)
+        return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used runs, other than keep, until the cache is at most max_bytes
+        """
+
+        entries = []
+        for key in os.listdir(self.root):
+            meta = self.meta(key)
+            if meta is not None:
+                entries.append((meta['last_used'], key, self.size(key)))
+
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_path(key))
+            total -= size
@@ -0,0 +1,152 @@
+import os
+import json
+import random
+import shutil
+import itertools
+from collections import Counter
+
+import countworld
+
+#version of the manifest format, a manifest with a different version is not resumed from
+MANIFEST_VERSION = 1
+
+def write_atomic(path, text):
+    """
+    Writes text to path so that path either has the old contents or all of text, even if we crash part way
+    """
+
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def load_manifest(path, config):
+    """
+    The manifest at path if it is for the same config, otherwise None
+    """
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('config') != config:
+        print(f'{path} is from a run with different arguments, starting again')
+        return None
+
+    return manifest
+
+def generate_splits(splits, config, kwargs, random_seed=None, chunk_size=1000, data_dir='data', stats=None):
+    """
+    Generates the examples for each split to {data_dir}/{name}.txt, chunk_size examples at a time, so that
+      if generation stops part way through, calling this again with the same arguments carries on from
+      the last chunk written and gives the same files as if it had never stopped
+
+    splits (list[tuple]): (name, number of examples) of each split, in the order they are generated
+    config (dict): every argument that changes the examples, including the number of examples in each split, a run is
+                   only resumed if its config is the same
+    kwargs (dict): arguments for countworld.iter_examples, other than n_examples, random_seed, rng, names and stats
+    stats (Counter): if given, the stats from iter_examples are added to it, including those from before resuming
+                     (a profiler in kwargs only covers the examples generated since resuming, and also times writing the chunks)
+
+    Each chunk is written to its own file in {data_dir}/checkpoint, and then a manifest saying how many
+      chunks of each split are done, with the random number generator state and the order of the name lists
+      after the last chunk. Both are written to a temporary file first and then renamed, so a crash never
+      leaves a partly written chunk or manifest. Once a split is done its chunks are put together into
+      {data_dir}/{name}.txt and once every split is done the checkpoint is removed
+    """
+
+    assert chunk_size > 0
+
+    #the same as the config saved in the manifest, where json turns tuples into lists
+    config = json.loads(json.dumps(config))
+
+    checkpoint_dir = os.path.join(data_dir, 'checkpoint')
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    #the same random number generator as the global one after random.seed, so the examples are the same as without checkpoints
+    rng = random.Random(random_seed)
+    names = (list(countworld.ENTITY_NAMES), list(countworld.OBJECT_NAMES), list(countworld.LOCATION_NAMES))
+    run_stats = {}
+
+    manifest = load_manifest(manifest_path, config)
+    if manifest is None:
+        manifest = {'version': MANIFEST_VERSION,
+                    'config': config,
+                    'chunks': {},
+                    'finished': [],
+                    'rng_state': rng.getstate(),
+                    'names': names,
+                    'stats': {}}
+        write_atomic(manifest_path, json.dumps(manifest))
+    else:
+        #json turns the tuples in the state into lists
+        version, internal_state, gauss_next = manifest['rng_state']
+        rng.setstate((version, tuple(internal_state), gauss_next))
+        for name_list, saved in zip(names, manifest['names']):
+            name_list[:] = saved
+        run_stats = manifest['stats']
+        print(f"resuming from {manifest_path}, {sum(manifest['chunks'].values())} chunks already done")
+
+    if stats is not None:
+        stats.update(run_stats)
+
+    def chunk_path(name, chunk):
+        return os.path.join(checkpoint_dir, f'{name}-{chunk:06d}.txt')
+
+    def chunk_sizes(n_examples):
+        return [min(chunk_size, n_examples - start) for start in range(0, n_examples, chunk_size)]
+
+    #only the examples after the last chunk written are generated
+    n_done = sum(sum(chunk_sizes(n)[:manifest['chunks'].get(name, 0)]) for name, n in splits)
+    n_remaining = sum(n for _, n in splits) - n_done
+    chunk_stats = Counter()
+    profiler = kwargs.get('profiler')
+    examples = countworld.iter_examples(n_remaining, **kwargs, rng=rng, names=names, stats=chunk_stats)
+
+    for name, n_examples in splits:
+
+        if name in manifest['finished']:
+            continue
+
+        for chunk, size in enumerate(chunk_sizes(n_examples)):
+
+            if chunk < manifest['chunks'].get(name, 0):
+                continue
+
+            chunk_examples = list(itertools.islice(examples, size))
+            if profiler is not None:
+                profiler.start()
+            write_atomic(chunk_path(name, chunk), ''.join(countworld.example_to_string(ex) for ex in chunk_examples))
+            if profiler is not None:
+                profiler.lap('write')
+
+            #the generator is paused after the last example, so this is the state the next chunk starts from
+            manifest['chunks'][name] = chunk + 1
+            manifest['rng_state'] = rng.getstate()
+            manifest['names'] = names
+            manifest['stats'] = dict(Counter(run_stats) + chunk_stats)
+            write_atomic(manifest_path, json.dumps(manifest))
+
+        #put the chunks together, then mark the split as done before removing them
+        path = os.path.join(data_dir, f'{name}.txt')
+        with open(path + '.tmp', 'wb') as f:
+            for chunk in range(len(chunk_sizes(n_examples))):
+                with open(chunk_path(name, chunk), 'rb') as chunk_file:
+                    shutil.copyfileobj(chunk_file, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        manifest['finished'].append(name)
+        write_atomic(manifest_path, json.dumps(manifest))
+        for chunk in range(len(chunk_sizes(n_examples))):
+            os.remove(chunk_path(name, chunk))
+
+    if stats is not None:
+        stats.update(chunk_stats)
+
+    shutil.rmtree(checkpoint_dir)
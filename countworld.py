@@ -1,11 +1,68 @@
+import os
 import random
-from collections import defaultdict
-from tqdm import tqdm
+import bisect
+import itertools
+from collections import deque, Counter
+
+#changed whenever the examples generated for the same arguments change, used by cache.py
+GENERATOR_VERSION = 1
 
 ENTITY_NAMES = ['ruben', 'jane', 'eric', 'eve', 'adam', 'claire', 'liam', 'emma', 'oliver', 'sophie']
 OBJECT_NAMES = ['leaves', 'rocks', 'flowers', 'insects', 'sticks', 'mushrooms', 'eggs', 'feathers', 'shells', 'berries']
 LOCATION_NAMES = ['park', 'forest', 'mountains', 'town', 'station', 'bridge', 'river', 'beach', 'school', 'stadium']
 
+#actions in the order of their ids
+ACTIONS = ['move', 'pick', 'drop']
+
+#question templates for each question family, see README for the list
+QUESTION_TEMPLATES = {1: 'how many {object} is {entity} carrying ?',
+                      2: 'how many entities picked up {object} ?',
+                      3: 'how many times were {object} picked up in total ?',
+                      4: 'how many {object} were picked up in total ?',
+                      5: 'how many entities dropped {object} ?',
+                      6: 'how many times were {object} dropped in total ?',
+                      7: 'how many {object} were dropped in total ?',
+                      8: 'how many different objects were picked up from the {location} ?',
+                      9: 'how many times were {object} picked up from the {location} ?',
+                      10: 'how many {object} were picked up from the {location} ?',
+                      11: 'how many times did {entity} pick up {object} ?',
+                      12: 'how many {object} did {entity} pick up ?',
+                      13: 'how many different objects were dropped at the {location} ?',
+                      14: 'how many times were {object} dropped at the {location} ?',
+                      15: 'how many {object} were dropped at the {location} ?',
+                      16: 'how many times did {entity} drop {object} ?',
+                      17: 'how many {object} did {entity} drop ?',
+                      18: 'how many entities visited the {location} ?',
+                      19: 'how many times did {entity} visit the {location} ?',
+                      20: 'how many times was the {location} visited in total ?'}
+
+#sentence templates for each action, target is the location for moves and the object for picks/drops
+SENTENCE_TEMPLATES = {'move': '{entity} went to the {target}',
+                      'pick': '{entity} picked up {n} {target}',
+                      'drop': '{entity} dropped {n} {target}'}
+
+#which entity/object/location each question family is asked about, in the order they are looped over
+QUESTION_SLOTS = {1: ('entity', 'object'),
+                  2: ('object',),
+                  3: ('object',),
+                  4: ('object',),
+                  5: ('object',),
+                  6: ('object',),
+                  7: ('object',),
+                  8: ('location',),
+                  9: ('object', 'location'),
+                  10: ('object', 'location'),
+                  11: ('object', 'entity'),
+                  12: ('object', 'entity'),
+                  13: ('location',),
+                  14: ('object', 'location'),
+                  15: ('object', 'location'),
+                  16: ('object', 'entity'),
+                  17: ('object', 'entity'),
+                  18: ('location',),
+                  19: ('entity', 'location'),
+                  20: ('location',)}
+
 def generate_examples(n_examples, 
                       n_entities, 
                       n_objects, 
@@ -16,8 +73,76 @@ def generate_examples(n_examples,
                       answer_values,
                       supporting_answers,
                       pick_max,
-                      random_seed=None):
+                      random_seed=None,
+                      lazy_questions=False,
+                      rng=None,
+                      progress=True,
+                      max_attempts=1000,
+                      steer=False,
+                      stats=None,
+                      structured=False,
+                      dedup=None,
+                      balance=None,
+                      names=None,
+                      vocab=None,
+                      profiler=None,
+                      name_pools=None):
+    """
+    Generates a list of n_examples examples, see iter_examples for the arguments
     """
+
+    return list(iter_examples(n_examples,
+                              n_entities,
+                              n_objects,
+                              n_locations,
+                              story_length,
+                              n_questions,
+                              which_questions,
+                              answer_values,
+                              supporting_answers,
+                              pick_max,
+                              random_seed,
+                              lazy_questions,
+                              rng,
+                              progress,
+                              max_attempts,
+                              steer,
+                              stats,
+                              structured,
+                              dedup,
+                              balance,
+                              names,
+                              vocab,
+                              profiler,
+                              name_pools))
+
+def iter_examples(n_examples, 
+                  n_entities, 
+                  n_objects, 
+                  n_locations, 
+                  story_length, 
+                  n_questions,
+                  which_questions,
+                  answer_values,
+                  supporting_answers,
+                  pick_max,
+                  random_seed=None,
+                  lazy_questions=False,
+                  rng=None,
+                  progress=True,
+                  max_attempts=1000,
+                  steer=False,
+                  stats=None,
+                  structured=False,
+                  dedup=None,
+                  balance=None,
+                  names=None,
+                  vocab=None,
+                  profiler=None,
+                  name_pools=None):
+    """
+    Generates examples one at a time, so only a single example is kept in memory
+
     n_examples (int): number of examples to generate
     n_entities (tuple[int]): 2 element tuple with (min, max) number of unique entities in the story, selected uniformly
     n_objects (tuple[int]): 2 element tuple with (min, max) number of unique objects in the story, selected uniformly
@@ -31,11 +156,59 @@ def generate_examples(n_examples,
                           the answer at that point in the story
     pick_max (int): when picking up items, picks up between [1, pick_max] items, selected uniformly
     random_seed (int): random seed for reproducibility, leave None for random random seed
+    lazy_questions (bool): if True, questions are drawn at random one at a time and checked against answer_values
+                           until there are enough, instead of listing every possible question and shuffling them,
+                           much faster with large numbers of entities/objects/locations but gives different examples
+                           for the same random_seed
+    rng (random.Random): random number generator to use instead of the global one from the random module, when given
+                         random_seed is not used and the name lists are copied instead of shuffled in place
+    progress (bool): show a progress bar
+    max_attempts (int): how many times to try generating each example before giving up, an attempt fails when
+                        answer_values leaves fewer questions than are needed, only that example is generated again
+    steer (bool): if True, stories avoid actions that take answers above answer_values[1] where possible, so fewer
+                  attempts fail with narrow answer ranges, but gives different stories for the same random_seed
+    stats (Counter): if given, counts of 'examples', 'attempts' and 'rejected' attempts are added to it
+    structured (bool): if True, no strings are made, each sentence of the story is a tuple of (action, entity,
+                       location or object, number of objects) and each question is a tuple of (question family,
+                       entity, object, location) with None for what the question doesn't ask about,
+                       see example_to_text to turn these into strings
+    dedup (dedup.DedupIndex): if given, examples already in the index are thrown away and generated again, and
+                              new examples are added to it, so the same index can be used to keep splits apart
+    balance (balance.AnswerBalancer): if given, questions are kept or thrown away based on how often their answer has
+                                      already been given for their question family, to balance the answers
+    names (tuple[list]): (entity, object, location) name lists to use with rng, which are shuffled in place, so
+                         generation can carry on from a saved rng state and name order
+    vocab (vocab.Vocab): if given, no strings are made and each sentence and question is a list of token ids from
+                         the vocab instead, see Vocab.encode
+    profiler (profiling.Profiler): if given, the time spent in each phase of generating the examples and counts of
+                                   the actions, questions and rejected attempts are added to it
+    name_pools (tuple[list]): (entity, object, location) names to use instead of ENTITY_NAMES, OBJECT_NAMES and
+                              LOCATION_NAMES, which can have any number of names. Each example draws its names
+                              from the pools with rng.sample instead of shuffling them, so the pools are never
+                              changed and their size doesn't change how long an example takes, but gives different
+                              examples for the same random_seed. With large numbers of entities/objects/locations in
+                              each story use lazy_questions, as listing every question takes as long as there are questions
     """
 
     #use a random seed is we specify it, if not then leave random
-    if random_seed is not None:
-        random.seed(random_seed)
+    #if given our own random number generator, use that and don't touch the global state
+    if name_pools is not None:
+        entity_names, object_names, location_names = [list(pool) for pool in name_pools]
+        for pool in (entity_names, object_names, location_names):
+            assert len(set(pool)) == len(pool), 'names in each pool must be different'
+        if rng is None:
+            rng = random
+            if random_seed is not None:
+                random.seed(random_seed)
+    elif rng is None:
+        rng = random
+        entity_names, object_names, location_names = ENTITY_NAMES, OBJECT_NAMES, LOCATION_NAMES
+        if random_seed is not None:
+            random.seed(random_seed)
+    elif names is not None:
+        entity_names, object_names, location_names = names
+    else:
+        entity_names, object_names, location_names = list(ENTITY_NAMES), list(OBJECT_NAMES), list(LOCATION_NAMES)
 
     #make sure we don't have min > max for entities/objects/locations/questions/story_length/answer_vals
     assert n_entities[0] <= n_entities[1]
@@ -54,76 +227,485 @@ def generate_examples(n_examples,
     assert len(which_questions) > 0 #make sure we are asking at least 1 question type
 
     #make sure we don't have more than max number of entities/objects/locations
-    assert n_entities[1] <= len(ENTITY_NAMES)
-    assert n_objects[1] <= len(OBJECT_NAMES)
-    assert n_locations[1] <= len(LOCATION_NAMES)
+    assert n_entities[1] <= len(entity_names)
+    assert n_objects[1] <= len(object_names)
+    assert n_locations[1] <= len(location_names)
 
     #must be able to pick up at least 1 object
     assert pick_max > 0
 
-    #list to store each story/question dict
-    examples = []
+    #must try at least once
+    assert max_attempts > 0
+
+    #tqdm is only imported when showing a progress bar, so importing countworld stays quick
+    indexes = range(n_examples)
+    if progress:
+        from tqdm import tqdm
+        indexes = tqdm(indexes)
 
     #generate examples
-    for _ in tqdm(range(n_examples)):
-
-        #make sure entities/objects/locations are random for each story
-        random.shuffle(ENTITY_NAMES)
-        random.shuffle(OBJECT_NAMES)
-        random.shuffle(LOCATION_NAMES)
-
-        #selecting the amount of entities/objects/locations/questions/story length for this example
-        example_n_entities = random.randint(n_entities[0], n_entities[1])
-        example_n_objects = random.randint(n_objects[0], n_objects[1])
-        example_n_locations = random.randint(n_locations[0], n_locations[1])
-        example_n_questions = random.randint(n_questions[0], n_questions[1])
-        example_story_length = random.randint(story_length[0], story_length[1])
-
-        #create lists of entities/objects/locations
-        entities = [Entity(ENTITY_NAMES[i]) for i in range(example_n_entities)]
-        objects = [Object(OBJECT_NAMES[i]) for i in range(example_n_objects)]
-        locations = [Location(LOCATION_NAMES[i]) for i in range(example_n_locations)]
-
-        #generate story/questions
-        story = []
-        questions = defaultdict(list)
-
-        while len(story) < example_story_length:
-
-            story, entities, objects, locations = generate_story(story, entities, objects, locations, pick_max)
-            questions = generate_questions(questions, entities, objects, locations, which_questions)  
-
-        #questions will be a dict where key is the string of the question and the value is the answer
-        #which is a list of the answer to the question at each step of the story
-        #want to transform into tuple, where if we only want a single answer, the answer is the last 
-        #value in the answer list
-        #also makes sure answers are within specified range
-        if supporting_answers:
-            questions = [(k, v) for k, v in questions.items() if min(v) >= answer_values[0] and max(v) <= answer_values[1]]
+    for _ in indexes:
+
+        #try generating the example until the answer range leaves enough questions
+        for _ in range(max_attempts):
+
+            example = generate_example(n_entities, 
+                                       n_objects, 
+                                       n_locations, 
+                                       story_length, 
+                                       n_questions,
+                                       which_questions,
+                                       answer_values,
+                                       supporting_answers,
+                                       pick_max,
+                                       lazy_questions,
+                                       steer,
+                                       structured or vocab is not None,
+                                       rng,
+                                       (entity_names, object_names, location_names),
+                                       dedup,
+                                       balance,
+                                       profiler,
+                                       name_pools is not None)
+
+            if stats is not None:
+                stats['attempts'] += 1
+            if profiler is not None:
+                profiler.counts['attempts'] += 1
+
+            if example is not None:
+                break
+
+            if stats is not None:
+                stats['rejected'] += 1
+
         else:
-            questions = [(k, v[-1]) for k, v in questions.items() if v[-1] >= answer_values[0] and v[-1] <= answer_values[1]]
+            if dedup is not None:
+                raise ValueError(f'could not generate an example that is not a duplicate with enough questions with answers in {answer_values} after {max_attempts} attempts')
+            raise ValueError(f'could not generate an example with enough questions with answers in {answer_values} after {max_attempts} attempts')
+
+        if stats is not None:
+            stats['examples'] += 1
+        if profiler is not None:
+            profiler.counts['examples'] += 1
+
+        if vocab is not None:
+            example = vocab.encode(example)
+
+        yield example
+
+def generate_example(n_entities, 
+                     n_objects, 
+                     n_locations, 
+                     story_length, 
+                     n_questions,
+                     which_questions,
+                     answer_values,
+                     supporting_answers,
+                     pick_max,
+                     lazy_questions,
+                     steer,
+                     structured,
+                     rng,
+                     names,
+                     dedup=None,
+                     balance=None,
+                     profiler=None,
+                     sample_names=False):
+    """
+    A single attempt at generating an example, see iter_examples for the arguments
+    names is a tuple of the (entity, object, location) name lists, which are shuffled in place, or if sample_names
+      is True, pools the names of each example are drawn from
+    Returns None if there are not enough questions with answers within answer_values (and kept by balance), or if the example is already in dedup
+    """
+
+    entity_names, object_names, location_names = names
+
+    if profiler is not None:
+        profiler.start()
+
+    #make sure entities/objects/locations are random for each story
+    if not sample_names:
+        rng.shuffle(entity_names)
+        rng.shuffle(object_names)
+        rng.shuffle(location_names)
+
+    #selecting the amount of entities/objects/locations/questions/story length for this example
+    example_n_entities = rng.randint(n_entities[0], n_entities[1])
+    example_n_objects = rng.randint(n_objects[0], n_objects[1])
+    example_n_locations = rng.randint(n_locations[0], n_locations[1])
+    example_n_questions = rng.randint(n_questions[0], n_questions[1])
+    example_story_length = rng.randint(story_length[0], story_length[1])
+
+    #only draw the names used from the pools, which takes as long as the number of names drawn
+    if sample_names:
+        entity_names = rng.sample(entity_names, example_n_entities)
+        object_names = rng.sample(object_names, example_n_objects)
+        location_names = rng.sample(location_names, example_n_locations)
+
+    #create lists of entities/objects/locations, their ids are their position in the list
+    entities = [Entity(i, entity_names[i]) for i in range(example_n_entities)]
+    objects = [Object(i, object_names[i]) for i in range(example_n_objects)]
+    locations = [Location(i, location_names[i]) for i in range(example_n_locations)]
+
+    #asking question 1 has always meant the objects are in the entities' inventories in the
+    #order of objects, instead of the order they are picked up, which changes which object is dropped
+    if 1 in which_questions:
+        for ent in entities:
+            ent.inventory_order = None
+
+    #generate story, the tracker updates the answers as each sentence is added
+    story = []
+    tracker = AnswerTracker([e.name for e in entities], [o.name for o in objects], [l.name for l in locations], supporting_answers)
+    if steer and answer_values[1] != float('inf'):
+        tracker.steer(which_questions, answer_values[1])
+
+    while len(story) < example_story_length:
+
+        story, entities, objects, locations = generate_story(story, entities, objects, locations, pick_max, tracker, rng, structured)
+
+    if profiler is not None:
+        profiler.lap('story')
+        profiler.actions.update(event[0] for event in tracker.events)
+
+    #the balancer decides from the final answer, once it has thrown away a question with an answer
+    #the other questions of that family with the same answer are too, or common answers would get
+    #through just by having more chances
+    accept = None
+    if balance is not None:
+        refused = set()
+        def accept(q):
+            answer = (q[0], tracker.answer(q))
+            if answer in refused:
+                return False
+            if balance.accept(answer[0], answer[1], rng):
+                return True
+            refused.add(answer)
+            if profiler is not None:
+                profiler.counts['questions_refused'] += 1
+            return False
+
+    #questions is a list of (family, entity, object, location), only keep the ones with answers within the specified range
+    if lazy_questions:
+        questions = tracker.sample_questions(which_questions, example_n_questions, answer_values, rng, accept,
+                                             None if profiler is None else profiler.counts)
+    else:
+        #in the order generate_questions would create them
+        questions = [q for q in tracker.questions(which_questions) if tracker.in_range(q, answer_values)]
+
+    if profiler is not None:
+        profiler.lap('questions')
+        if not lazy_questions:
+            profiler.counts['questions_checked'] += sum(count for _, count in tracker.question_counts(which_questions))
+            profiler.counts['questions_in_range'] += len(questions)
+
+    #check if pruning meant we don't have enough questions
+    if len(questions) < example_n_questions:
+        if profiler is not None:
+            #when drawing questions lazily the balancer is asked as they are drawn
+            profiler.counts['rejected_balance' if lazy_questions and accept is not None and refused else 'rejected_range'] += 1
+        return None
+
+    #randomly shuffle so questions are different
+    if not lazy_questions:
+        rng.shuffle(questions)
+
+        #only go through the shuffled questions until there are enough the balancer keeps
+        if accept is not None:
+            kept = []
+            for q in questions:
+                if accept(q):
+                    kept.append(q)
+                    if len(kept) == example_n_questions:
+                        break
+            if len(kept) < example_n_questions:
+                if profiler is not None:
+                    profiler.lap('filter')
+                    profiler.counts['rejected_balance'] += 1
+                return None
+            questions = kept
+
+    #only want n questions per example
+    questions = questions[:example_n_questions]
+
+    if profiler is not None:
+        profiler.lap('filter')
+
+    #only the questions we keep are turned into strings, if we want supporting answers then
+    #the answer is a list of the answer at each step of the story
+    if supporting_answers:
+        answers = tracker.supporting_answers(questions)
+    else:
+        answers = [tracker.answer(q) for q in questions]
+
+    if profiler is not None:
+        profiler.lap('answers')
+
+    #the same story and questions with different names is still a duplicate
+    if dedup is not None and not dedup.add(tracker.fingerprint(questions, answers)):
+        if profiler is not None:
+            profiler.lap('filter')
+            profiler.counts['rejected_duplicate'] += 1
+        return None
 
-        #check if pruning meant we don't have enough questions
-        assert len(questions) >= example_n_questions
+    #only count the answers of examples that are kept
+    if balance is not None:
+        for q in questions:
+            balance.add(q[0], tracker.answer(q))
 
-        #randomly shuffle so questions are different
-        random.shuffle(questions)
+    if profiler is not None:
+        profiler.lap('filter')
 
-        #only want n questions per example
-        questions = questions[:example_n_questions]
+    if structured:
+        questions = [(tracker.question_names(q), a) for q, a in zip(questions, answers)]
+    else:
+        questions = [(tracker.question_string(q), a) for q, a in zip(questions, answers)]
+
+    if profiler is not None:
+        profiler.lap('answers')
+        profiler.counts['questions_kept'] += len(questions)
+
+    return {'story': story, 'questions': questions}
 
-        #append example to list
-        examples.append({'story': story, 'questions': questions})
+def example_to_text(example):
+    """
+    Turns an example generated with structured=True into the same example with strings
+    """
 
-    return examples
+    story = [SENTENCE_TEMPLATES[action].format(entity=entity, target=target, n=n) for action, entity, target, n in example['story']]
+    questions = [(QUESTION_TEMPLATES[family].format(entity=entity, object=obj, location=location), a) for (family, entity, obj, location), a in example['questions']]
+    return {'story': story, 'questions': questions}
 
-def generate_story(story, entities, objects, locations, pick_max):
+def example_to_string(ex):
+    """
+    The lines of the file for a single example as one string
+    """
+
+    lines = [f's {s}\n' for s in ex['story']]
+    questions = ex['questions']
+    for (q, _) in questions:
+        lines.append(f'q {q}\n')
+    for (_, a) in questions:
+        if isinstance(a, list):
+            a = ' '.join([str(_a) for _a in a])
+        lines.append(f'a {a}\n')
+    return ''.join(lines)
+
+def examples_to_file(name, examples, buffer_size=1<<20, binary_file=False, data_dir='data', profiler=None, vocab=None):
+    """
+    Writes examples to {data_dir}/{name}.txt as they are generated, examples can be any iterable
+    Writes go through a buffer of buffer_size bytes, so memory doesn't depend on the number of examples
+    If binary_file is True, the examples must be structured and are also written to {data_dir}/{name}.cwb
+      with the name ids from vocab (a vocab.Vocab, the built in names if not given)
+    The file is written to a temporary file which then replaces {data_dir}/{name}.txt, so a file that is
+      hard linked somewhere else (e.g. by cache.DatasetCache) is never overwritten, and if generating the
+      examples fails the temporary files are removed and the files are left as they were
+    If profiler is given, the time spent writing (but not generating) the examples is added to its 'write' phase
+    """
+
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'{name}.txt')
+
+    try:
+        with open(path + '.tmp', 'w+', buffering=buffer_size) as f:
+            if binary_file:
+                #binary imports countworld, so is only imported here
+                import binary
+                #the binary file is only replaced if every example is written
+                with binary.BinaryWriter(os.path.join(data_dir, f'{name}.cwb'), vocab=vocab) as writer:
+                    for ex in examples:
+                        if profiler is not None:
+                            profiler.start()
+                        writer.write(ex)
+                        f.write(example_to_string(example_to_text(ex)))
+                        if profiler is not None:
+                            profiler.lap('write')
+            elif profiler is not None:
+                for ex in examples:
+                    profiler.start()
+                    f.write(example_to_string(ex))
+                    profiler.lap('write')
+            else:
+                for ex in examples:
+                    f.write(example_to_string(ex))
+    except BaseException:
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+
+    os.replace(path + '.tmp', path)
+
+def shard_rng(random_seed, shard):
+    """
+    Independent random number generator for a shard of examples, depends only on
+      the random seed and the shard index, so is the same however many processes are used
+    """
+
+    if random_seed is None:
+        return random.Random()
+    return random.Random(f'{random_seed}-{shard}')
+
+def generate_shard(job):
+    """
+    Generates the examples for a single shard, job is a tuple of (shard index, number of examples,
+      random seed, dict of iter_examples arguments), used by iter_examples_parallel
+    Returns the examples, the stats and the profiler for the shard, the profiler is None unless kwargs has one
+    """
+
+    shard, n_examples, random_seed, kwargs = job
+    stats = Counter()
+    if kwargs.get('profiler') is not None:
+        import profiling
+        #each shard is profiled on its own, to be added to the profiler in the main process
+        kwargs = dict(kwargs, profiler=profiling.Profiler())
+    examples = generate_examples(n_examples, **kwargs, rng=shard_rng(random_seed, shard), progress=False, stats=stats)
+    return examples, stats, kwargs.get('profiler')
+
+def generate_examples_parallel(n_examples,
+                               n_entities,
+                               n_objects,
+                               n_locations,
+                               story_length,
+                               n_questions,
+                               which_questions,
+                               answer_values,
+                               supporting_answers,
+                               pick_max,
+                               random_seed=None,
+                               lazy_questions=False,
+                               workers=1,
+                               shard_size=1000,
+                               max_attempts=1000,
+                               steer=False,
+                               stats=None,
+                               structured=False,
+                               profiler=None,
+                               progress=True,
+                               name_pools=None):
+    """
+    Generates a list of n_examples examples using multiple processes, see iter_examples_parallel for the arguments
+    """
+
+    return list(iter_examples_parallel(n_examples,
+                                       n_entities,
+                                       n_objects,
+                                       n_locations,
+                                       story_length,
+                                       n_questions,
+                                       which_questions,
+                                       answer_values,
+                                       supporting_answers,
+                                       pick_max,
+                                       random_seed,
+                                       lazy_questions,
+                                       workers,
+                                       shard_size,
+                                       max_attempts,
+                                       steer,
+                                       stats,
+                                       structured,
+                                       profiler,
+                                       progress,
+                                       name_pools))
+
+def iter_examples_parallel(n_examples,
+                           n_entities,
+                           n_objects,
+                           n_locations,
+                           story_length,
+                           n_questions,
+                           which_questions,
+                           answer_values,
+                           supporting_answers,
+                           pick_max,
+                           random_seed=None,
+                           lazy_questions=False,
+                           workers=1,
+                           shard_size=1000,
+                           max_attempts=1000,
+                           steer=False,
+                           stats=None,
+                           structured=False,
+                           profiler=None,
+                           progress=True,
+                           name_pools=None):
+    """
+    Same as iter_examples, but splits the examples into shards of shard_size examples
+      which are generated by a pool of workers processes
+
+    Each shard has its own random number generator seeded from random_seed and the shard
+      index, so the examples are the same for any number of workers (but different to
+      iter_examples with the same random_seed)
+
+    Only a few shards per worker are generated ahead of the examples being used, so memory
+      depends on workers and shard_size and not n_examples
+
+    stats is updated as each shard is used, so should be a Counter (or dict with the keys already set), and
+      so is profiler, with the times summed over the workers
+    """
+
+    assert workers > 0
+    assert shard_size > 0
+
+    kwargs = {'n_entities': n_entities,
+              'n_objects': n_objects,
+              'n_locations': n_locations,
+              'story_length': story_length,
+              'n_questions': n_questions,
+              'which_questions': which_questions,
+              'answer_values': answer_values,
+              'supporting_answers': supporting_answers,
+              'pick_max': pick_max,
+              'lazy_questions': lazy_questions,
+              'max_attempts': max_attempts,
+              'steer': steer,
+              'structured': structured,
+              'profiler': profiler,
+              'name_pools': name_pools}
+
+    jobs = ((shard, min(shard_size, n_examples - start), random_seed, kwargs) for shard, start in enumerate(range(0, n_examples, shard_size)))
+
+    #only imported here so importing countworld stays quick, and tqdm only when showing a progress bar
+    import multiprocessing
+    bar = None
+    if progress:
+        from tqdm import tqdm
+        bar = tqdm(total=n_examples)
+
+    def finished(shard):
+        shard_examples, shard_stats, shard_profiler = shard.get()
+        if stats is not None:
+            stats.update(shard_stats)
+        if profiler is not None:
+            profiler.update(shard_profiler)
+        if bar is not None:
+            bar.update(len(shard_examples))
+        return shard_examples
+
+    try:
+        with multiprocessing.Pool(workers) as pool:
+
+            #shards being generated, in order
+            pending = deque()
+
+            for job in jobs:
+                pending.append(pool.apply_async(generate_shard, (job,)))
+                if len(pending) >= 2 * workers:
+                    yield from finished(pending.popleft())
+
+            while pending:
+                yield from finished(pending.popleft())
+    finally:
+        if bar is not None:
+            bar.close()
+
+def generate_story(story, entities, objects, locations, pick_max, tracker=None, rng=random, structured=False):
     """
     Takes in a partial story, list of entities, list of objects and list of locations
     
     Generates the next sentence in the story by randomly picking an entity and then
-      randomly picking an action for that entity, also updates the stats for each
-      entity, object and location, i.e. amount of times location was visited by that entity
+      randomly picking an action for that entity, also updates the entity's position and
+      inventory, the counts for each entity, object and location are kept by the tracker
     
     Available actions are: moving, picking and dropping.
     - moving takes the entity from one location to another
@@ -134,19 +716,34 @@ def generate_story(story, entities, objects, locations, pick_max):
       be to move to a location
     Entities can only perform a drop action if they are carrying at least one object
     When an entity picks up an object they pick up between 1-3 of a single object
+
+    If an AnswerTracker is passed, each action is also passed to the tracker
+    If the tracker is steering (see AnswerTracker.steer), locations, objects and amounts that would take an
+      answer above the max answer are avoided, unless every action would
+    All random choices are made with rng, which defaults to the global one from the random module
+    If structured is True, the sentence added to the story is a tuple of (action, entity, location or object, number of objects)
     """
 
+    steer = tracker is not None and tracker.steer_max is not None
+
     #select entity at random
-    actor = random.choice(entities)
+    actor = rng.choice(entities)
             
     #if it's position is none, needs to go somewhere before it can act
-    if actor.position == None:
-        actor.position = random.choice(locations).name
-        for l in locations:
-            if l.name == actor.position:
-                l.entity_visits[actor.name] += 1
+    if actor.position is None:
+        start_locations = locations
+        if steer:
+            start_locations = [l for l in locations if tracker.fits('move', actor.id, None, l.id, 0)] or locations
+        location = rng.choice(start_locations)
+        actor.position = location.id
+
+        if tracker is not None:
+            tracker.apply('move', actor.id, None, location.id, 0)
     
-        story.append(f'{actor.name} went to the {actor.position}')
+        if structured:
+            story.append(('move', actor.name, location.name, 0))
+        else:
+            story.append(f'{actor.name} went to the {location.name}')
 
         return story, entities, objects, locations
 
@@ -163,297 +760,598 @@ def generate_story(story, entities, objects, locations, pick_max):
         action_choices.remove('move')
 
     #can only drop items if carrying any
-    if sum(actor.inventory.values()) < 1:
+    if actor.carrying < 1:
         action_choices.remove('drop')
 
+    #when steering, only want actions that have at least one choice which keeps the answers in range
+    if steer:
+        steer_choices = {'move': [l for l in locations if l.id != actor.position and tracker.fits('move', actor.id, None, l.id, 0)],
+                         'pick': [o for o in objects if tracker.fits('pick', actor.id, o.id, actor.position, 1)],
+                         'drop': [objects[o] for o in actor.carried() if tracker.fits('drop', actor.id, o, actor.position, 1)]}
+        steered_choices = [a for a in action_choices if len(steer_choices[a]) > 0]
+        if len(steered_choices) > 0:
+            action_choices = steered_choices
+        else:
+            steer = False
+
     #randomly pick an available action to carry out
-    action = random.choice(action_choices)
+    action = rng.choice(action_choices)
 
     if action == 'move':
 
-        #make sure we're already at a location
-        assert actor.position is not None
-
         #make sure there is another location to actually go to
         assert len(locations) > 1
 
         #only want to move to locations not already at
-        available_locations = [l.name for l in locations if l.name is not actor.position]
-        
-        #pick location
-        new_location = random.choice(available_locations)
-
-        #make sure it isn't the current location
-        assert actor.position != new_location
+        if steer:
+            location = rng.choice(steer_choices['move'])
+        else:
+            #the same as choosing from the locations without the current one, without making that list
+            i = rng.randrange(len(locations) - 1)
+            location = locations[i if i < actor.position else i + 1]
 
         #update new position
-        actor.position = new_location
-        
-        #update location's visited count
-        for l in locations:
-            if l.name == new_location:
-                l.entity_visits[actor.name] += 1
+        actor.position = location.id
+
+        if tracker is not None:
+            tracker.apply('move', actor.id, None, location.id, 0)
 
         #update story
-        story.append(f'{actor.name} went to the {new_location}')
+        if structured:
+            story.append(('move', actor.name, location.name, 0))
+        else:
+            story.append(f'{actor.name} went to the {location.name}')
 
         return story, entities, objects, locations
 
     elif action == 'pick':
 
-        #make sure we're at a location
-        assert actor.position is not None
-
         #select which object to pick up
-        picked_object = random.choice(objects).name
-
-        #select how many to pick up
-        n_picked = random.randint(1,pick_max)
+        if steer:
+            obj = rng.choice(steer_choices['pick'])
+        else:
+            obj = rng.choice(objects)
 
-        #update actor's inventory
-        actor.inventory[picked_object] += n_picked
+        #select how many to pick up, when steering only up to the most that keeps the answers in range
+        if steer:
+            pick_max = max(n for n in range(1, pick_max+1) if tracker.fits('pick', actor.id, obj.id, actor.position, n))
+        n_picked = rng.randint(1,pick_max)
 
-        #update objects picked count
-        for o in objects:
-            if o.name == picked_object:
-                o.n_picked.append(n_picked)
-                o.picked_entity[actor.name].append(n_picked)
-                o.picked_location[actor.position].append(n_picked)
+        #update actor's inventory, objects are only in the inventory once they have been picked up
+        if obj.id not in actor.inventory:
+            actor.inventory[obj.id] = 0
+            if actor.inventory_order is not None:
+                actor.inventory_order.append(obj.id)
+        actor.inventory[obj.id] += n_picked
+        actor.carrying += n_picked
 
-        #update locations pick count
-        for l in locations:
-            if l.name == actor.position:
-                l.picked_objects[picked_object].append(n_picked)
+        if tracker is not None:
+            tracker.apply('pick', actor.id, obj.id, actor.position, n_picked)
 
         #update story
-        story.append(f'{actor.name} picked up {n_picked} {picked_object}')
+        if structured:
+            story.append(('pick', actor.name, obj.name, n_picked))
+        else:
+            story.append(f'{actor.name} picked up {n_picked} {obj.name}')
         
         return story, entities, objects, locations
 
     else:
 
         #can only have picked drop if actor is carrying any items
-        assert sum(actor.inventory.values()) > 0
+        assert actor.carrying > 0
 
         #select which objects to drop
-        available_objects = [obj for obj in actor.inventory.keys() if actor.inventory[obj] > 0]
+        if steer:
+            available_objects = steer_choices['drop']
+        else:
+            available_objects = [objects[o] for o in actor.carried()]
 
         #get dropped object
-        dropped_object = random.choice(available_objects)
+        obj = rng.choice(available_objects)
 
-        #select how many to drop
-        n_dropped = random.randint(1, actor.inventory[dropped_object])
+        #select how many to drop, when steering only up to the most that keeps the answers in range
+        drop_max = actor.inventory[obj.id]
+        if steer:
+            drop_max = max(n for n in range(1, drop_max+1) if tracker.fits('drop', actor.id, obj.id, actor.position, n))
+        n_dropped = rng.randint(1, drop_max)
 
         #update actor's inventory
-        actor.inventory[dropped_object] -= n_dropped
-
-        #update objects drop count
-        for o in objects:
-            if o.name == dropped_object:
-                o.n_dropped.append(n_dropped)
-                o.dropped_entity[actor.name].append(n_dropped)
-                o.dropped_location[actor.position].append(n_dropped)
-
-        #update locations drop count
-        for l in locations:
-            if l.name == actor.position:
-                l.dropped_objects[dropped_object].append(n_dropped)
+        actor.inventory[obj.id] -= n_dropped
+        actor.carrying -= n_dropped
 
         #make sure it hasn't gone negative
-        assert actor.inventory[dropped_object] >= 0
+        assert actor.inventory[obj.id] >= 0
+
+        if tracker is not None:
+            tracker.apply('drop', actor.id, obj.id, actor.position, n_dropped)
 
         #update story
-        story.append(f'{actor.name} dropped {n_dropped} {dropped_object}')
+        if structured:
+            story.append(('drop', actor.name, obj.name, n_dropped))
+        else:
+            story.append(f'{actor.name} dropped {n_dropped} {obj.name}')
 
         return story, entities, objects, locations
 
-def generate_questions(questions, entities, objects, locations, which_questions):
+def generate_questions(questions, tracker, which_questions):
     """
     Takes in: a question dict that has the key being the string of the question and the 
-      value being a list of the answers at each sentence in the story, a list of entities
-      a list of objects and a list of locations.
+      value being a list of the answers at each sentence in the story, and the AnswerTracker
+      for the story
 
-    Generates the next answer for each question using the attributes of the entities, objects
-    and locations
+    Adds the current answer to each question, call after each sentence to get the answers
+      at every step of the story, AnswerTracker.supporting_answers does the same for only
+      the questions you want
     """
 
-    #1. how many <object> is <entity> carrying ?
-    if 1 in which_questions:
-        for ent in entities:
-            for obj in objects:
-                question = f'how many {obj.name} is {ent.name} carrying ?'
-                answer = ent.inventory[obj.name]
-                questions[question].append(answer)
-
-    #2. how many entities picked up <object> ?
-    if 2 in which_questions:
-        for obj in objects:
-            question = f'how many entities picked up {obj.name} ?'
-            answer = len([x for x in obj.picked_entity.values() if len(x) > 0])
-            questions[question].append(answer)
-
-    #3. how many times were <object> picked up in total ?
-    if 3 in which_questions:
-        for obj in objects:
-            question = f'how many times were {obj.name} picked up in total ?'
-            answer = len(obj.n_picked)
-            questions[question].append(answer)
-
-    #4. how many <object> were picked up in total ?
-    if 4 in which_questions:
-        for obj in objects:
-            question = f'how many {obj.name} were picked up in total ?'
-            answer = sum(obj.n_picked)
-            questions[question].append(answer)
-
-    #5. how many entities dropped <object> ?
-    if 5 in which_questions:
-        for obj in objects:
-            question = f'how many entities dropped {obj.name} ?'
-            answer = len([x for x in obj.dropped_entity.values() if len(x) > 0])
-            questions[question].append(answer)
-
-    #6. how many times were <object> dropped in total ?
-    if 6 in which_questions:
-        for obj in objects:
-            question = f'how many times were {obj.name} dropped in total ?'
-            answer = len(obj.n_dropped)
-            questions[question].append(answer)
-
-    #7. how many <object> were dropped in total ?
-    if 7 in which_questions:
-        for obj in objects:
-            question = f'how many {obj.name} were dropped in total ?'
-            answer = sum(obj.n_dropped)
-            questions[question].append(answer)
-
-    #8. how many different objects were picked up from the <location> ?
-    if 8 in which_questions:
-        for loc in locations:
-            question = f'how many different objects were picked up from the {loc.name} ?'
-            answer = len([x for x in obj.picked_location.values() if len(x) > 0])
-            questions[question].append(answer)
-
-    #9. how many times were <object> picked up from the <location> ?
-    if 9 in which_questions:
-        for obj in objects:
-            for loc in locations:
-                question = f'how many times were {obj.name} picked up from the {loc.name} ?'
-                answer = len(obj.picked_location[loc.name])
-                questions[question].append(answer)
-
-    #10. how many <object> were picked up from the <location> ?
-    if 10 in which_questions:
-        for obj in objects:
-            for loc in locations:
-                question = f'how many {obj.name} were picked up from the {loc.name} ?'
-                answer = sum(obj.picked_location[loc.name])
-                questions[question].append(answer)
-
-    #11. how many times did <entity> pick up <object> ?
-    if 11 in which_questions:
-        for obj in objects:
-            for ent in entities:
-                question = f'how many times did {ent.name} pick up {obj.name} ?'
-                answer = len(obj.picked_entity[ent.name])
-                questions[question].append(answer)
-
-    #12. how many <object> did <entity> pick up ?
-    if 12 in which_questions:
-        for obj in objects:
-            for ent in entities:
-                question = f'how many {obj.name} did {ent.name} pick up ?'
-                answer = sum(obj.picked_entity[ent.name])
-                questions[question].append(answer)
-
-    #13. how many different objects were dropped at the <location> ?
-    if 13 in which_questions:
-        for loc in locations:
-            question = f'how many different objects were dropped at the {loc.name} ?'
-            answer = len([x for x in obj.dropped_location.values() if len(x) > 0])
-            questions[question].append(answer)
-
-    #14. how many times were <object> dropped at the <location> ?
-    if 14 in which_questions:
-        for obj in objects:
-            for loc in locations:
-                question = f'how many times were {obj.name} dropped at the {loc.name} ?'
-                answer = len(obj.dropped_location[loc.name])
-                questions[question].append(answer)
-
-    #15. how many <object> were dropped at the <location> ?
-    if 15 in which_questions:
-        for obj in objects:
-            for loc in locations:
-                question = f'how many {obj.name} were dropped at the {loc.name} ?'
-                answer = sum(obj.dropped_location[loc.name])
-                questions[question].append(answer)
-
-    #16. how many times did <entity> drop <object> ?
-    if 16 in which_questions:
-        for obj in objects:
-            for ent in entities:
-                question = f'how many times did {ent.name} drop {obj.name} ?'
-                answer = len(obj.dropped_entity[ent.name])
-                questions[question].append(answer)
-
-    #17. how many <object> did <entity> drop ?
-    if 17 in which_questions:
-        for obj in objects:
-            for ent in entities:
-                question = f'how many {obj.name} did {ent.name} drop ?'
-                answer = len(obj.dropped_entity[ent.name])
-                questions[question].append(answer)
-
-    #18. how many entities visited the <location> ?
-    if 18 in which_questions:
-        for loc in locations:
-            question = f'how many entities visited the {loc.name} ?'
-            answer = len([x for x in loc.entity_visits.values() if x > 0])
-            questions[question].append(answer)
-
-    #19. how many times did <entity> visit <location> ?
-    if 19 in which_questions:
-        for ent in entities:
-            for loc in locations:
-                question = f'how many times did {ent.name} visit the {loc.name} ?'
-                answer = loc.entity_visits[ent.name]
-                questions[question].append(answer)
-
-    #20. how many times was the <location> visited in total ?
-    if 20 in which_questions:
-        for loc in locations:
-            question = f'how many times was the {loc.name} visited in total ?'
-            answer = sum([x for x in loc.entity_visits.values()])
-            questions[question].append(answer)
+    for question in tracker.questions(which_questions):
+        questions[tracker.question_string(question)].append(tracker.answer(question))
 
     return questions
 
+#layouts of the AnswerTracker counters, by number of entities, objects and locations
+TRACKER_LAYOUTS = {}
+
+#stories with more counters than this keep them in a SparseCounters instead of a list, and their layouts aren't kept
+DENSE_COUNTERS = 1 << 16
+
+def tracker_layout(n_e, n_o, n_l):
+    """
+    Dict of the (offset, entity stride, object stride, location stride) of each question family's
+      counters and the total number of counters, for a story with n_e entities, n_o objects and n_l locations
+    """
+
+    if (n_e, n_o, n_l) in TRACKER_LAYOUTS:
+        return TRACKER_LAYOUTS[(n_e, n_o, n_l)]
+
+    #families 8 and 13 only have a single counter for the last object
+    sizes = {1: n_e*n_o, 2: n_o, 3: n_o, 4: n_o, 5: n_o, 6: n_o, 7: n_o, 8: 1, 9: n_o*n_l, 10: n_o*n_l,
+             11: n_o*n_e, 12: n_o*n_e, 13: 1, 14: n_o*n_l, 15: n_o*n_l, 16: n_o*n_e, 18: n_l, 19: n_e*n_l, 20: n_l}
+    strides = {1: (n_o, 1, 0), 8: (0, 0, 0), 13: (0, 0, 0), 19: (n_l, 0, 1)}
+    strides.update({f: (0, 1, 0) for f in (2, 3, 4, 5, 6, 7)})
+    strides.update({f: (0, n_l, 1) for f in (9, 10, 14, 15)})
+    strides.update({f: (1, n_e, 0) for f in (11, 12, 16)})
+    strides.update({f: (0, 0, 1) for f in (18, 20)})
+
+    layout = {}
+    offset = 0
+    for family, size in sizes.items():
+        layout[family] = (offset,) + strides[family]
+        offset += size
+    layout[17] = layout[16]
+
+    #there can be a huge number of different sizes of large stories
+    if offset <= DENSE_COUNTERS:
+        TRACKER_LAYOUTS[(n_e, n_o, n_l)] = (layout, offset)
+    return layout, offset
+
+class SparseCounters(dict):
+    """
+    Counters that are 0 until they are changed, used by AnswerTracker when there are too many counters
+      to make a list of them for every story, so it only takes as much memory as the counters that change
+    """
+
+    __slots__ = ()
+
+    def __missing__(self, counter):
+        return 0
+
+class AnswerTracker:
+    """
+    Keeps a running count for the answer to every question so each sentence added to the
+      story only updates the answers it affects, instead of re-calculating every question
+      after every sentence like generate_questions
+
+    Questions are tuples of (family, entity, object, location) indexes, with None for
+      the slots that question family doesn't use. Each question points at a single counter.
+      Questions 16 and 17 share a counter, and all question 8 (and 13) questions share a
+      counter, as these are the answers generate_questions gives for them
+
+    If supporting_answers is True, also keeps the min/max value of every counter so the
+      answer range can be checked without keeping the answer at each step of the story
+
+    The counters are a list, or a SparseCounters when there are more than DENSE_COUNTERS of them, e.g.
+      with hundreds of entities, objects and locations, so only the counters the story changes are kept
+    """
+
+    __slots__ = ('entities', 'objects', 'locations', 'track_range', 'layout', 'values', 'mins', 'maxs',
+                 'events', 'steer_families', 'steer_max')
+
+    def __init__(self, entities, objects, locations, supporting_answers=False):
+
+        self.entities = entities
+        self.objects = objects
+        self.locations = locations
+        self.track_range = supporting_answers
+
+        self.layout, offset = tracker_layout(len(entities), len(objects), len(locations))
+
+        counters = (lambda: [0] * offset) if offset <= DENSE_COUNTERS else SparseCounters
+        self.values = counters()
+        if self.track_range:
+            self.mins = counters()
+            self.maxs = counters()
+
+        #actions so far as (action, entity, object, location, n) indexes, used to replay the story
+        self.events = []
+
+        #set by steer
+        self.steer_families = set()
+        self.steer_max = None
+
+    def counter(self, question):
+        """
+        Index in self.values of the counter holding the answer to question
+        """
+
+        family, e, o, l = question
+        offset, e_stride, o_stride, l_stride = self.layout[family]
+        return offset + (e or 0) * e_stride + (o or 0) * o_stride + (l or 0) * l_stride
+
+    def questions(self, which_questions):
+        """
+        List of every question for which_questions, in the same order generate_questions creates them
+        """
+
+        slot_sizes = {'entity': len(self.entities), 'object': len(self.objects), 'location': len(self.locations)}
+        questions = []
+        for family in sorted(which_questions):
+            slots = QUESTION_SLOTS[family]
+            for ids in itertools.product(*[range(slot_sizes[s]) for s in slots]):
+                ids = dict(zip(slots, ids))
+                questions.append((family, ids.get('entity'), ids.get('object'), ids.get('location')))
+        return questions
+
+    def question_counts(self, which_questions):
+        """
+        List of (family, number of questions) for which_questions
+        """
+
+        slot_sizes = {'entity': len(self.entities), 'object': len(self.objects), 'location': len(self.locations)}
+        counts = []
+        for family in sorted(which_questions):
+            count = 1
+            for s in QUESTION_SLOTS[family]:
+                count *= slot_sizes[s]
+            counts.append((family, count))
+        return counts
+
+    def question_at(self, index, counts):
+        """
+        The question at position index of questions(), without creating the whole list
+        counts is the output of question_counts
+        """
+
+        for family, count in counts:
+            if index < count:
+                break
+            index -= count
+
+        slot_sizes = {'entity': len(self.entities), 'object': len(self.objects), 'location': len(self.locations)}
+        ids = {}
+        for s in reversed(QUESTION_SLOTS[family]):
+            index, ids[s] = divmod(index, slot_sizes[s])
+        return (family, ids.get('entity'), ids.get('object'), ids.get('location'))
+
+    def sample_questions(self, which_questions, n, answer_values, rng=random, accept=None, stats=None):
+        """
+        Draws up to n different questions at random with answers within answer_values
+        Only the questions drawn are checked, so when most questions are in range only a few are looked at
+        When few questions are in range, after 10 * n draws the counters are checked instead, which with
+          lots of entities, objects and locations are far fewer than the questions
+        If accept is given, questions are also only kept if accept(question) is True
+        If stats is given, the number of questions checked and in range are added to its 'questions_checked' and 'questions_in_range'
+        """
+
+        counts = self.question_counts(which_questions)
+        total = sum(count for _, count in counts)
+
+        questions = []
+        tried = set()
+        checked = 0
+        in_range = 0
+        while len(questions) < n and len(tried) < total:
+
+            #once most questions have been tried, drawing one we haven't tried gets slow
+            #so go through the rest of them in a random order instead
+            if len(tried) > total // 2:
+                remaining = [i for i in range(total) if i not in tried]
+                rng.shuffle(remaining)
+                for i in remaining:
+                    question = self.question_at(i, counts)
+                    checked += 1
+                    if self.in_range(question, answer_values):
+                        in_range += 1
+                        if accept is None or accept(question):
+                            questions.append(question)
+                            if len(questions) == n:
+                                break
+                break
+
+            #drawing questions at random can take as long as going through all of them when few are in range
+            if len(tried) >= 10 * n:
+                candidates, counters_checked = self.in_range_questions(counts, answer_values, {self.question_at(i, counts) for i in tried})
+                checked += counters_checked
+                in_range += len(candidates)
+                rng.shuffle(candidates)
+                for question in candidates:
+                    if accept is None or accept(question):
+                        questions.append(question)
+                        if len(questions) == n:
+                            break
+                break
+
+            i = rng.randrange(total)
+            if i in tried:
+                continue
+            tried.add(i)
+            question = self.question_at(i, counts)
+            checked += 1
+            if self.in_range(question, answer_values):
+                in_range += 1
+                if accept is None or accept(question):
+                    questions.append(question)
+
+        if stats is not None:
+            stats['questions_checked'] += checked
+            stats['questions_in_range'] += in_range
+
+        return questions
+
+    def in_range_questions(self, counts, answer_values, skip):
+        """
+        (every question not in skip with an answer within answer_values, number of counters checked), found
+          from the counters, so only the counters the story changed are checked if unchanged counters are out of range
+        counts is the output of question_counts
+        """
+
+        #only the changed counters are kept when they are sparse, the rest are 0
+        changed = None
+        if isinstance(self.values, SparseCounters) and not answer_values[0] <= 0 <= answer_values[1]:
+            changed = sorted(self.values)
+
+        questions = []
+        checked = 0
+        for family, _ in counts:
+            start = self.layout[family][0]
+            end = start + self.n_counters(family)
+            counters = range(start, end) if changed is None else changed[bisect.bisect_left(changed, start):bisect.bisect_left(changed, end)]
+            for c in counters:
+                checked += 1
+                if self.counter_in_range(c, answer_values):
+                    questions.extend(q for q in self.counter_questions(family, c - start) if q not in skip)
+        return questions, checked
+
+    def n_counters(self, family):
+        """
+        Number of counters of family, the slots with a stride of 0 share a counter, e.g. every question 8 and 13
+        """
+
+        strides = dict(zip(('entity', 'object', 'location'), self.layout[family][1:]))
+        slot_sizes = {'entity': len(self.entities), 'object': len(self.objects), 'location': len(self.locations)}
+        n = 1
+        for s in QUESTION_SLOTS[family]:
+            if strides[s] > 0:
+                n *= slot_sizes[s]
+        return n
+
+    def counter_questions(self, family, index):
+        """
+        Every question of family that uses counter index of the family's counters
+        """
+
+        strides = dict(zip(('entity', 'object', 'location'), self.layout[family][1:]))
+        slot_sizes = {'entity': len(self.entities), 'object': len(self.objects), 'location': len(self.locations)}
+        counted = sorted((s for s in QUESTION_SLOTS[family] if strides[s] > 0), key=lambda s: -strides[s])
+        shared = [s for s in QUESTION_SLOTS[family] if strides[s] == 0]
+
+        ids = {}
+        for s in counted:
+            ids[s], index = divmod(index, strides[s])
+        questions = []
+        for values in itertools.product(*[range(slot_sizes[s]) for s in shared]):
+            ids.update(zip(shared, values))
+            questions.append((family, ids.get('entity'), ids.get('object'), ids.get('location')))
+        return questions
+
+    def question_names(self, question):
+        """
+        The question with the names of the entity/object/location instead of their indexes
+        """
+
+        family, e, o, l = question
+        return (family,
+                None if e is None else self.entities[e],
+                None if o is None else self.objects[o],
+                None if l is None else self.locations[l])
+
+    def question_string(self, question):
+
+        family, entity, obj, location = self.question_names(question)
+        return QUESTION_TEMPLATES[family].format(entity=entity, object=obj, location=location)
+
+    def answer(self, question):
+        return self.values[self.counter(question)]
+
+    def fingerprint(self, questions, answers):
+        """
+        Hash of the story so far and the questions with their answers, with the entities, objects and locations
+          numbered in the order they first appear instead of by index, so it doesn't depend on their names
+        Only hashes ints, so is the same in every process
+        """
+
+        entities, objects, locations = {}, {}, {}
+        events = []
+        for action, e, o, l, n in self.events:
+            events.append((ACTIONS.index(action),
+                           entities.setdefault(e, len(entities)),
+                           -1 if o is None else objects.setdefault(o, len(objects)),
+                           locations.setdefault(l, len(locations)),
+                           n))
+
+        renamed = []
+        for family, e, o, l in questions:
+            renamed.append((family,
+                            -1 if e is None else entities.setdefault(e, len(entities)),
+                            -1 if o is None else objects.setdefault(o, len(objects)),
+                            -1 if l is None else locations.setdefault(l, len(locations))))
+
+        answers = tuple(tuple(a) if isinstance(a, list) else a for a in answers)
+        return hash((tuple(events), tuple(renamed), answers))
+
+    def in_range(self, question, answer_values):
+        """
+        If the answer is within answer_values, when keeping supporting answers every answer in the story has to be
+        """
+
+        return self.counter_in_range(self.counter(question), answer_values)
+
+    def counter_in_range(self, c, answer_values):
+
+        if self.track_range:
+            return self.mins[c] >= answer_values[0] and self.maxs[c] <= answer_values[1]
+        else:
+            return answer_values[0] <= self.values[c] <= answer_values[1]
+
+    def supporting_answers(self, questions):
+        """
+        Replays the story to get the answer at each step of the story, only for questions
+        """
+
+        counters = [self.counter(q) for q in questions]
+        answers = [[] for _ in questions]
+        replay = AnswerTracker(self.entities, self.objects, self.locations)
+        for event in self.events:
+            replay.apply(*event)
+            values = replay.values
+            for answer, c in zip(answers, counters):
+                answer.append(values[c])
+        return answers
+
+    def changes(self, action, e, o, l, n):
+        """
+        List of (family, counter, amount) for each counter a single action changes
+        """
+
+        values = self.values
+        layout = self.layout
+        n_e, n_o, n_l = len(self.entities), len(self.objects), len(self.locations)
+
+        if action == 'move':
+            visits = layout[19][0] + e*n_l + l
+            changes = [(19, visits, 1), (20, layout[20][0] + l, 1)]
+            if values[visits] == 0:
+                changes.append((18, layout[18][0] + l, 1))
+            return changes
+
+        #picks and drops update the same counters, just different ones of them
+        if action == 'pick':
+            changes = [(1, layout[1][0] + e*n_o + o, n)]
+            entities, times, total, locations, times_location, total_location, times_entity, total_entity = 2, 3, 4, 8, 9, 10, 11, 12
+        else:
+            changes = [(1, layout[1][0] + e*n_o + o, -n)]
+            entities, times, total, locations, times_location, total_location, times_entity, total_entity = 5, 6, 7, 13, 14, 15, 16, None
+
+        times_entity_counter = layout[times_entity][0] + o*n_e + e
+        if values[times_entity_counter] == 0:
+            changes.append((entities, layout[entities][0] + o, 1))
+        times_location_counter = layout[times_location][0] + o*n_l + l
+        if o == n_o - 1 and values[times_location_counter] == 0:
+            changes.append((locations, layout[locations][0], 1))
+
+        changes.append((times, layout[times][0] + o, 1))
+        changes.append((total, layout[total][0] + o, n))
+        changes.append((times_location, times_location_counter, 1))
+        changes.append((total_location, layout[total_location][0] + o*n_l + l, n))
+        changes.append((times_entity, times_entity_counter, 1))
+        if total_entity is not None:
+            changes.append((total_entity, layout[total_entity][0] + o*n_e + e, n))
+
+        return changes
+
+    def apply(self, action, e, o, l, n):
+        """
+        Updates the counters affected by a single action
+        """
+
+        self.events.append((action, e, o, l, n))
+        for _, counter, amount in self.changes(action, e, o, l, n):
+            self._add(counter, amount)
+
+    def steer(self, which_questions, max_answer):
+        """
+        Makes generate_story avoid actions that take the answer to any of which_questions above max_answer
+        """
+
+        self.steer_families = set(which_questions)
+        #question 17 uses the question 16 counter
+        if 17 in self.steer_families:
+            self.steer_families.add(16)
+        self.steer_max = max_answer
+
+    def fits(self, action, e, o, l, n):
+        """
+        If the action keeps all the answers being steered at or below the max answer, takes indexes
+        """
+
+        values = self.values
+        for family, counter, amount in self.changes(action, e, o, l, n):
+            if amount > 0 and family in self.steer_families and values[counter] + amount > self.steer_max:
+                return False
+        return True
+
+    def _add(self, counter, amount):
+
+        value = self.values[counter] + amount
+        self.values[counter] = value
+
+        #the range only covers the answers after each sentence, so starts after the first one
+        if self.track_range:
+            if len(self.events) == 1:
+                self.mins[counter] = value
+                self.maxs[counter] = value
+            elif value < self.mins[counter]:
+                self.mins[counter] = value
+            elif value > self.maxs[counter]:
+                self.maxs[counter] = value
+
 class Entity:
 
-    def __init__(self, name):
+    __slots__ = ('id', 'name', 'position', 'inventory', 'carrying', 'inventory_order')
 
+    def __init__(self, id, name):
+
+        self.id = id
         self.name = name
-        self.position = None
-        self.inventory = defaultdict(int) #number of each object entity is carrying
+        self.position = None #id of the location the entity is at
+        self.inventory = {} #number of each object entity is carrying, by object id, for objects it has picked up
+        self.carrying = 0 #total number of objects entity is carrying
+        self.inventory_order = [] #object ids in the order the entity first picked them up, drops are chosen in this order, None for in order of id
+
+    def carried(self):
+        """
+        Ids of the objects the entity is carrying, in the order drops are chosen from
+        """
+
+        if self.inventory_order is None:
+            return sorted(o for o, n in self.inventory.items() if n > 0)
+        return [o for o in self.inventory_order if self.inventory[o] > 0]
 
 class Object:
 
-    def __init__(self, name):
+    __slots__ = ('id', 'name')
 
+    def __init__(self, id, name):
+
+        self.id = id
         self.name = name
-        self.n_picked = [] #count of how many of object was picked up in all locations, length gives number of times this object was picked up, sum gives total count of objects picked up
-        self.n_dropped = [] #count of how many of object was picked up in all locations
-        self.picked_location = defaultdict(list) #how many times item was picked at each location, length gives number of times this object was picked up at each location, sum gives total number of objects picked up at this location
-        self.picked_entity = defaultdict(list) #how many times item was picked by each entity, length gives number of times entity picked up this object, sum gives total of this object was picked up by entity
-        self.dropped_location = defaultdict(list) #how many times item was picked at each location
-        self.dropped_entity = defaultdict(list) #how many times item was picked at each location
 
 class Location:
 
-    def __init__(self, name):
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
 
+        self.id = id
         self.name = name
-        self.entity_visits = defaultdict(int) #times each entity visted, sum to get total visits
-        self.picked_objects = defaultdict(list) #count of how many of each object picked up here, length gives number of times object x was picked up at this location, sum gives total number of object x picked up at this location
-        self.dropped_objects = defaultdict(list) #count of how many of each object dropped here  
\ No newline at end of file
@@ -0,0 +1,113 @@
+import math
+
+class DedupIndex:
+    """
+    Set of example fingerprints (see AnswerTracker.fingerprint) used to stop the same example
+      appearing twice, pass it to countworld.generate_examples as dedup
+
+    If capacity is None, the fingerprints are kept in a set, which is exact but uses ~70 bytes per example
+    Otherwise they are kept in a Bloom filter sized so that error_rate of new examples are wrongly
+      called duplicates once capacity examples have been added, which uses ~1.8 bytes per example for
+      an error_rate of 0.001, so can hold tens of millions of examples
+
+    Counts how many fingerprints were checked and how many of them were duplicates, and
+      clear() empties the index but keeps the counts
+    """
+
+    def __init__(self, capacity=None, error_rate=0.001):
+
+        assert capacity is None or capacity > 0
+        assert 0 < error_rate < 1
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.checked = 0
+        self.duplicates = 0
+
+        if capacity is None:
+            self.fingerprints = set()
+        else:
+            #optimal number of bits and hashes for the capacity and error rate
+            self.n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+            self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+            self.bits = bytearray((self.n_bits + 7) // 8)
+
+        #number of fingerprints added since the index was cleared
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def positions(self, fingerprint):
+        """
+        Bits of the Bloom filter set for fingerprint, made by double hashing from the two halves of the fingerprint
+        """
+
+        fingerprint &= 0xFFFFFFFFFFFFFFFF
+        h1, h2 = fingerprint & 0xFFFFFFFF, (fingerprint >> 32) | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def __contains__(self, fingerprint):
+
+        if self.capacity is None:
+            return fingerprint in self.fingerprints
+
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.positions(fingerprint))
+
+    def add(self, fingerprint):
+        """
+        Adds fingerprint to the index, returns False if it was already in the index
+        """
+
+        self.checked += 1
+
+        if self.capacity is None:
+            if fingerprint in self.fingerprints:
+                self.duplicates += 1
+                return False
+            self.fingerprints.add(fingerprint)
+            self.size += 1
+            return True
+
+        bits = self.bits
+        new = False
+        for p in self.positions(fingerprint):
+            byte, bit = p >> 3, 1 << (p & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                new = True
+
+        if not new:
+            self.duplicates += 1
+            return False
+        self.size += 1
+        return True
+
+    def clear(self):
+
+        if self.capacity is None:
+            self.fingerprints.clear()
+        else:
+            self.bits = bytearray(len(self.bits))
+        self.size = 0
+
+    def false_positive_rate(self):
+        """
+        Chance a new fingerprint is wrongly called a duplicate at the current size, always 0 for the exact index
+        """
+
+        if self.capacity is None:
+            return 0.0
+        return (1 - math.exp(-self.n_hashes * self.size / self.n_bits)) ** self.n_hashes
+
+    def report(self):
+        """
+        Dict of the counts and rates, for printing or saving
+        """
+
+        return {'checked': self.checked,
+                'duplicates': self.duplicates,
+                'collision_rate': self.duplicates / max(self.checked, 1),
+                'size': self.size,
+                'false_positive_rate': self.false_positive_rate()}
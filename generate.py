@@ -1,6 +1,12 @@
 import countworld
+import writers
 import argparse
+import collections
+import itertools
 import os
+import random
+import shutil
+import tempfile
 
 parser = argparse.ArgumentParser(description='Generate countworld examples', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--n_train_examples', default=10_000, type=int, help='Number of (S,Q,A) training examples')
@@ -22,60 +28,295 @@ parser.add_argument('--answer_values_max', default=float('inf'), type=int, help=
 parser.add_argument('--supporting_answers', action='store_true', help='Use this flag to get answer for every sentence in a story')
 parser.add_argument('--pick_max', default=3, type=int, help='Maximum number of objects an entity picks up during a pick action')
 parser.add_argument('--seed', default=1234, type=int, help='Random seed for generation')
-args = parser.parse_args()
-
-N_TRAIN_EXAMPLES = args.n_train_examples #examples
-N_VALID_EXAMPLES = args.n_valid_examples #examples
-N_TEST_EXAMPLES = args.n_test_examples #examples
-N_EXAMPLES = N_TRAIN_EXAMPLES+N_VALID_EXAMPLES+N_TEST_EXAMPLES # examples
-N_ENTITIES = (args.n_entities_min, args.n_entities_max) #(min, max) entities per story
-N_OBJECTS = (args.n_objects_min, args.n_objects_max) #(min, max) objects per story
-N_LOCATIONS = (args.n_locations_min, args.n_locations_max) #(min, max) locations per story
-STORY_LENGTH = (args.story_length_min, args.story_length_max) #(min, max) story length
-N_QUESTIONS = (args.n_questions_min, args.n_questions_max) #(min, max) questions per story
-WHICH_QUESTIONS = {int(q) for q in args.which_questions.split(',')} #which questions to ask
-ANSWER_VALUES = (args.answer_values_min, args.answer_values_max) #(min, max) value of answers
-SUPPORTING_ANSWERS = args.supporting_answers #supporting answers
-PICK_MAX = args.pick_max #maximum items to pick up at once
-RANDOM_SEED = args.seed #random seed
-
-examples = countworld.generate_examples(N_EXAMPLES, 
-                                        N_ENTITIES, 
-                                        N_OBJECTS, 
-                                        N_LOCATIONS, 
-                                        STORY_LENGTH, 
-                                        N_QUESTIONS,
-                                        WHICH_QUESTIONS,
-                                        ANSWER_VALUES,
-                                        SUPPORTING_ANSWERS,
-                                        PICK_MAX,
-                                        RANDOM_SEED) 
-
-train_examples = examples[:N_TRAIN_EXAMPLES]
-valid_examples = examples[N_TRAIN_EXAMPLES:N_TRAIN_EXAMPLES+N_VALID_EXAMPLES]
-test_examples = examples[N_TRAIN_EXAMPLES+N_VALID_EXAMPLES:]
-
-
-
-def examples_to_file(name, examples):
-
-    os.makedirs('data', exist_ok=True)
-
-    with open(f'data/{name}.txt', 'w+') as f:
-        for ex in examples:
-            story = ex['story']
-            for s in story:
-                f.write(f's {s}\n')
-            questions = ex['questions']
-            for (q, _) in questions:
-                f.write(f'q {q}\n')
-            for (_, a) in questions:
-                if isinstance(a, list):
-                    a = ' '.join([str(_a) for _a in a])
-                    f.write(f'a {a}\n')
-                else:
-                    f.write(f'a {a}\n')
-
-examples_to_file('train', train_examples)
-examples_to_file('valid', valid_examples)
-examples_to_file('test', test_examples)
+parser.add_argument('--workers', default=0, type=int, help='Number of processes used to generate examples, 0 generates them all in this process')
+parser.add_argument('--shard_size', default=1000, type=int, help='Number of examples generated at once by each process when using workers')
+parser.add_argument('--max_attempts', default=1000, type=int, help='Number of times to try generating each example before giving up when answer values leave too few questions')
+parser.add_argument('--steer', action='store_true', help='Use this flag to make stories avoid actions that take answers above the maximum answer value')
+parser.add_argument('--batch_size', default=0, type=int, help='Number of stories to simulate at once with numpy, 0 generates them one at a time')
+parser.add_argument('--binary', action='store_true', help='Use this flag to also write each split as a binary file of token ids, see binary.py')
+parser.add_argument('--lazy_questions', action='store_true', help='Use this flag to only check the answers of randomly drawn questions instead of every possible question')
+parser.add_argument('--dedup', default='none', choices=['none', 'split', 'all'], help='Throw away duplicate examples within each split, or within and across all splits')
+parser.add_argument('--dedup_capacity', default=0, type=int, help='Number of examples the dedup index is sized for, using a Bloom filter, 0 keeps every example exactly')
+parser.add_argument('--balance', action='store_true', help='Use this flag to keep questions so each question family has a similar number of each answer')
+parser.add_argument('--checkpoint_size', default=0, type=int, help='Number of examples written at a time so a stopped run can be resumed by running it again, 0 writes each split in one go')
+parser.add_argument('--cache_dir', default='', type=str, help='Directory to keep generated datasets in, so running again with the same arguments reuses them instead of generating them again, empty to not cache')
+parser.add_argument('--cache_max_gb', default=10, type=float, help='Size the cache is kept under by removing the least recently used datasets')
+parser.add_argument('--compression', default='none', choices=['none', 'gzip', 'zstd'], help='Compress each split, zstd needs the zstandard package')
+parser.add_argument('--write_batch_size', default=1000, type=int, help='Number of examples put together and written at once by each split\'s writer thread')
+parser.add_argument('--profile', default='', type=str, help='File to write a json report of the time spent in each phase of generation and counts of actions, questions and rejected attempts to, empty to not profile')
+parser.add_argument('--entity_names', default='', type=str, help='File with one entity name per line to draw the entities of each story from, empty to use the built in names')
+parser.add_argument('--object_names', default='', type=str, help='File with one object name per line to draw the objects of each story from, empty to use the built in names')
+parser.add_argument('--location_names', default='', type=str, help='File with one location name per line to draw the locations of each story from, empty to use the built in names')
+parser.add_argument('--data_dir', default='data', type=str, help='Directory the splits are written to')
+parser.add_argument('--no_progress', action='store_true', help='Use this flag to not show a progress bar')
+
+def config(**kwargs):
+    """
+    The arguments for main with the default value for any not given, e.g. config(n_train_examples=100, seed=1),
+      for generating examples in this process instead of running generate.py
+    """
+
+    args = parser.parse_args([])
+    for name, value in kwargs.items():
+        assert hasattr(args, name), f'unknown argument: {name}'
+        setattr(args, name, value)
+    return args
+
+def name_pools(args):
+    """
+    The (entity, object, location) names from the files in args, with the built in names for any not given,
+      or None if no files are given
+    """
+
+    paths = (args.entity_names, args.object_names, args.location_names)
+    if not any(paths):
+        return None
+
+    pools = []
+    for path, names in zip(paths, (countworld.ENTITY_NAMES, countworld.OBJECT_NAMES, countworld.LOCATION_NAMES)):
+        if path:
+            with open(path) as f:
+                names = [line.strip() for line in f if line.strip()]
+        pools.append(list(names))
+    return tuple(pools)
+
+def examples_config(args):
+    """
+    Every argument that changes the examples generated, other than how many there are, with the names from the
+      name files instead of their paths, used for the cache key and to check a checkpoint is from the same run
+    The workers only change the examples by whether there are any, and dedup within splits depends on where the splits start
+    """
+
+    config = {k: v for k, v in vars(args).items() if k not in ('n_train_examples', 'n_valid_examples', 'n_test_examples',
+                                                               'workers', 'shard_size', 'checkpoint_size', 'cache_dir', 'cache_max_gb', 'profile',
+                                                               'write_batch_size', 'data_dir', 'no_progress',
+                                                               'entity_names', 'object_names', 'location_names')}
+    config['workers'] = args.workers > 0
+    config['shard_size'] = args.shard_size if args.workers > 0 else None
+    config['splits'] = [('train', args.n_train_examples), ('valid', args.n_valid_examples), ('test', args.n_test_examples)] if args.dedup == 'split' else None
+    config['name_pools'] = name_pools(args)
+    return config
+
+def example_kwargs(args):
+    """
+    The arguments of countworld.iter_examples given by args, other than the number of examples, random_seed and
+      the ones for the objects that keep state while generating (stats, dedup, balance and profiler)
+    """
+
+    return {'n_entities': (args.n_entities_min, args.n_entities_max), #(min, max) entities per story
+            'n_objects': (args.n_objects_min, args.n_objects_max), #(min, max) objects per story
+            'n_locations': (args.n_locations_min, args.n_locations_max), #(min, max) locations per story
+            'story_length': (args.story_length_min, args.story_length_max), #(min, max) story length
+            'n_questions': (args.n_questions_min, args.n_questions_max), #(min, max) questions per story
+            'which_questions': {int(q) for q in args.which_questions.split(',')}, #which questions to ask
+            'answer_values': (args.answer_values_min, args.answer_values_max), #(min, max) value of answers
+            'supporting_answers': args.supporting_answers, #supporting answers
+            'pick_max': args.pick_max, #maximum items to pick up at once
+            'lazy_questions': args.lazy_questions, #draw questions one at a time
+            'max_attempts': args.max_attempts, #attempts per example
+            'steer': args.steer, #keep answers below maximum answer value while generating stories
+            'name_pools': name_pools(args)} #names to draw from instead of the built in ones
+
+def stream(args, stats=None, dedup_index=None, balancer=None, profiler=None):
+    """
+    Generator of the examples for args, the examples of each split one after another, in the same order as
+      they are written by main, without writing them. The examples are structured if args.binary is set
+    The other arguments are passed to the generator, see countworld.iter_examples
+    """
+
+    n_examples = args.n_train_examples + args.n_valid_examples + args.n_test_examples
+    kwargs = example_kwargs(args)
+    progress = not args.no_progress
+
+    if args.batch_size > 0:
+        assert kwargs['name_pools'] is None, 'entity_names, object_names and location_names only work without batch_size'
+        assert not args.lazy_questions and not args.steer, 'lazy_questions and steer only work without batch_size'
+        #numpy is only needed for batched generation
+        import batch
+        return batch.iter_examples(n_examples,
+                                   kwargs['n_entities'],
+                                   kwargs['n_objects'],
+                                   kwargs['n_locations'],
+                                   kwargs['story_length'],
+                                   kwargs['n_questions'],
+                                   kwargs['which_questions'],
+                                   kwargs['answer_values'],
+                                   kwargs['supporting_answers'],
+                                   kwargs['pick_max'],
+                                   args.seed,
+                                   args.batch_size,
+                                   stats,
+                                   args.binary,
+                                   args.max_attempts)
+    elif args.workers > 0:
+        return countworld.iter_examples_parallel(n_examples,
+                                                 **kwargs,
+                                                 random_seed=args.seed,
+                                                 workers=args.workers,
+                                                 shard_size=args.shard_size,
+                                                 stats=stats,
+                                                 structured=args.binary,
+                                                 profiler=profiler,
+                                                 progress=progress)
+    else:
+        #its own random number generator and name lists, so every call with the same args gives the same examples
+        return countworld.iter_examples(n_examples,
+                                        **kwargs,
+                                        rng=random.Random(args.seed),
+                                        progress=progress,
+                                        stats=stats,
+                                        structured=args.binary,
+                                        dedup=dedup_index,
+                                        balance=balancer,
+                                        profiler=profiler)
+
+def main(args=None):
+    """
+    Generates the splits for args (see config), or the command line arguments if args is None, and writes them
+      to args.data_dir
+    Returns a dict of the 'stats' of the generation attempts, the 'paths' of the files written, if the splits
+      were 'cached' (served from args.cache_dir), and the 'balance' and 'profile' reports when they are used
+    """
+
+    if args is None:
+        args = parser.parse_args()
+
+    N_TRAIN_EXAMPLES = args.n_train_examples #examples
+    N_VALID_EXAMPLES = args.n_valid_examples #examples
+    N_TEST_EXAMPLES = args.n_test_examples #examples
+    RANDOM_SEED = args.seed #random seed
+    WORKERS = args.workers #processes to generate with
+    SHARD_SIZE = args.shard_size #examples per shard
+    BINARY = args.binary #also write binary files
+    BATCH_SIZE = args.batch_size #stories simulated at once with numpy
+    DEDUP = args.dedup #where duplicate examples are thrown away
+    DEDUP_CAPACITY = args.dedup_capacity #examples the dedup index is sized for
+    BALANCE = args.balance #balance the answers of each question family
+    CHECKPOINT_SIZE = args.checkpoint_size #examples per checkpoint chunk
+    CACHE_DIR = args.cache_dir #where generated datasets are cached
+    CACHE_MAX_BYTES = int(args.cache_max_gb * 2**30) #size of the cache
+    COMPRESSION = None if args.compression == 'none' else args.compression #compression of each split
+    WRITE_BATCH_SIZE = args.write_batch_size #examples written at once
+    PROFILE = args.profile #where the profile report is written
+    DATA_DIR = args.data_dir #where the splits are written
+    SPLITS = [('train', N_TRAIN_EXAMPLES), ('valid', N_VALID_EXAMPLES), ('test', N_TEST_EXAMPLES)] #(name, examples) of each split
+
+    paths = {name: os.path.join(DATA_DIR, f'{name}.txt{writers.EXTENSIONS[COMPRESSION]}') for name, _ in SPLITS}
+    result = {'stats': collections.Counter(), 'paths': paths, 'cached': False}
+
+    #times and counts of each phase of generation, the batched generator isn't profiled
+    profiler = None
+    if PROFILE:
+        assert BATCH_SIZE == 0, 'profile only works without batch_size'
+        import profiling
+        profiler = profiling.Profiler()
+
+    dataset_cache = None
+    if CACHE_DIR:
+        assert not BINARY and COMPRESSION is None, 'cache_dir only works without binary and compression'
+        #the feature modules are only imported when they are used, so importing generate stays quick
+        import cache
+        dataset_cache = cache.DatasetCache(CACHE_DIR, CACHE_MAX_BYTES)
+        CACHE_CONFIG = examples_config(args)
+        CACHE_KEY = cache.config_key(CACHE_CONFIG)
+        if profiler is not None:
+            profiler.start()
+        if dataset_cache.serve(CACHE_KEY, SPLITS, DATA_DIR):
+            print(f'served from {os.path.join(CACHE_DIR, CACHE_KEY)}')
+            result['cached'] = True
+            if profiler is not None:
+                #nothing is generated, so the profile only has the time spent serving the splits as 'write'
+                profiler.lap('write')
+                profiler.served_from = os.path.join(CACHE_DIR, CACHE_KEY)
+                profiler.save(PROFILE)
+                result['profile'] = profiler.report()
+                print(f'profile of serving from the cache written to {PROFILE}')
+            return result
+
+    #counts of generation attempts, to see how many examples are thrown away by the answer values
+    stats = result['stats']
+
+    #duplicates are found as the examples are generated, which only happens in this process
+    dedup_index = None
+    if DEDUP != 'none':
+        assert BATCH_SIZE == 0 and WORKERS == 0, 'dedup only works without batch_size and workers'
+        import dedup
+        dedup_index = dedup.DedupIndex(DEDUP_CAPACITY or None)
+
+    #answers are balanced as the examples are generated, which only happens in this process
+    balancer = None
+    if BALANCE:
+        assert BATCH_SIZE == 0 and WORKERS == 0, 'balance only works without batch_size and workers'
+        import balance
+        balancer = balance.AnswerBalancer()
+
+    #checkpoints save the state of a single generator between chunks
+    if CHECKPOINT_SIZE > 0:
+        assert BATCH_SIZE == 0 and WORKERS == 0 and DEDUP == 'none' and not BALANCE and not BINARY and COMPRESSION is None, \
+            'checkpoint_size only works without batch_size, workers, dedup, balance, binary and compression'
+
+    #binary files are written by countworld.examples_to_file, one split at a time, all with the same vocab
+    if BINARY:
+        assert COMPRESSION is None, 'compression only works without binary'
+        import vocab
+        pools = name_pools(args)
+        binary_vocab = vocab.Vocab() if pools is None else vocab.Vocab(*pools)
+
+    if CHECKPOINT_SIZE > 0:
+        #the examples are generated by checkpoint.generate_splits instead
+        import checkpoint
+        checkpoint.generate_splits(SPLITS,
+                                   dict(examples_config(args), splits=SPLITS),
+                                   dict(example_kwargs(args), progress=not args.no_progress, profiler=profiler),
+                                   RANDOM_SEED,
+                                   CHECKPOINT_SIZE,
+                                   DATA_DIR,
+                                   stats=stats)
+    else:
+        #examples are generated as they are written, so are never all in memory at once
+        examples = stream(args, stats, dedup_index, balancer, profiler)
+
+        def after_split(name):
+            if dedup_index is not None:
+                #examples are only generated as they are written, so clearing here only keeps the splits apart
+                report = dedup_index.report()
+                print(f"after {name}: {report['duplicates']} duplicates in {report['checked']} examples, {report['collision_rate']:.2%} collision rate, {report['false_positive_rate']:.2e} false positive rate")
+                if DEDUP == 'split':
+                    dedup_index.clear()
+
+        if BINARY:
+            #the splits are written to a temporary directory and only moved to DATA_DIR once every split has been,
+            #so if generation fails none of them are changed, the same as writers.write_splits
+            os.makedirs(DATA_DIR, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=DATA_DIR)
+            try:
+                for name, n_split_examples in SPLITS:
+                    countworld.examples_to_file(name, itertools.islice(examples, n_split_examples), binary_file=True, data_dir=tmp_dir, profiler=profiler, vocab=binary_vocab)
+                    after_split(name)
+                for name, _ in SPLITS:
+                    for extension in ('.txt', '.cwb'):
+                        os.replace(os.path.join(tmp_dir, name + extension), os.path.join(DATA_DIR, name + extension))
+            finally:
+                shutil.rmtree(tmp_dir)
+        else:
+            #each split is written by its own thread, while the next split is generated
+            writers.write_splits(SPLITS, examples, DATA_DIR, compression=COMPRESSION, batch_size=WRITE_BATCH_SIZE, profiler=profiler, on_split=after_split)
+
+    if dataset_cache is not None:
+        dataset_cache.store(CACHE_KEY, CACHE_CONFIG, SPLITS, DATA_DIR)
+
+    if balancer is not None:
+        report = result['balance'] = balancer.report()
+        print(f"balance kept {report['checked'] - report['rejected']} of {report['checked']} questions checked")
+
+    if profiler is not None:
+        profiler.save(PROFILE)
+        report = result['profile'] = profiler.report()
+        print(f"profile written to {PROFILE}: " + ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in report['times'].items()))
+
+    print(f"generated {stats['examples']} examples in {stats['attempts']} attempts, {stats['examples'] / max(stats['attempts'], 1):.1%} accepted")
+
+    return result
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import os
+import re
+import mmap
+from array import array
+
+#version of the index file format, stored at the start of every index
+INDEX_VERSION = 1
+
+#end of an example: an answer line followed by the first sentence of the next story
+EXAMPLE_END = re.compile(rb'\na [^\n]*\n(?=s )')
+
+#an answer line with more than one answer in it, used to guess if a file has supporting answers when not told
+SUPPORTING_ANSWER = re.compile(rb'(?:^|\n)a [^\n]* ')
+
+def parse_example(text, supporting_answers):
+    """
+    Parses the lines of a single example written by countworld.examples_to_file into the same
+      dict generate_examples gives, text is the example's lines as a string ending in a newline
+    supporting_answers (bool): if the answers are lists of the answer at each sentence of the story
+    """
+
+    #splitting on the line prefixes removes them and splits the lines in one go
+    text = '\n' + text.rstrip('\n')
+    q = text.find('\nq ')
+    a = text.find('\na ', q)
+    story = text[:q].split('\ns ')[1:]
+    questions = text[q:a].split('\nq ')[1:]
+    answers = text[a:].split('\na ')[1:]
+
+    if supporting_answers:
+        answers = [[int(_a) for _a in answer.split()] for answer in answers]
+    else:
+        answers = [int(answer) for answer in answers]
+
+    return {'story': story, 'questions': list(zip(questions, answers))}
+
+def parse(data, supporting_answers, offsets=None):
+    """
+    Parses bytes holding any number of whole examples
+    offsets (list[int]): where each example starts and ends in data, found from data when not given
+    """
+
+    if offsets is None:
+        offsets = [0] + [m.end() for m in EXAMPLE_END.finditer(data)]
+        if offsets[-1] < len(data):
+            offsets.append(len(data))
+
+    text = data.decode()
+    #text is ascii, so byte offsets are also string offsets
+    assert len(text) == len(data)
+    return [parse_example(text[start:end], supporting_answers) for start, end in zip(offsets, offsets[1:])]
+
+def index_path(path):
+    return f'{path}.idx'
+
+def build_index(path, supporting_answers=None):
+    """
+    Finds where each example starts in the file at path and if it has supporting answers, saves it
+      to the sidecar index file next to it and returns (offsets, supporting_answers)
+    The index holds the version, the size and modification time of the file, if there are
+      supporting answers, then the byte offset of the start of each example and the end of the file
+    If supporting_answers isn't given it is guessed from whether any answer line has more than one answer,
+      which can't tell supporting answers from single answers when every story is one sentence long
+    """
+
+    stat = os.stat(path)
+    offsets = array('q', [0])
+    guess = supporting_answers is None
+    if guess:
+        supporting_answers = False
+
+    if stat.st_size > 0:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets.extend(m.end() for m in EXAMPLE_END.finditer(data))
+            if guess:
+                supporting_answers = SUPPORTING_ANSWER.search(data) is not None
+        offsets.append(stat.st_size)
+
+    index = array('q', [INDEX_VERSION, stat.st_size, stat.st_mtime_ns, supporting_answers])
+    index.extend(offsets)
+
+    #written to a temporary file first so a partly written index is never read
+    with open(index_path(path) + '.tmp', 'wb') as f:
+        index.tofile(f)
+    os.replace(index_path(path) + '.tmp', index_path(path))
+
+    return offsets, supporting_answers
+
+def load_index(path, supporting_answers=None):
+    """
+    (offsets, supporting_answers) for the file at path, from the sidecar index if it is
+      up to date with the file, otherwise the index is built again
+    If supporting_answers is given and the index says otherwise, the index is built again with it
+    """
+
+    stat = os.stat(path)
+    try:
+        with open(index_path(path), 'rb') as f:
+            index = array('q', f.read())
+    except FileNotFoundError:
+        return build_index(path, supporting_answers)
+
+    if len(index) < 4 or list(index[:3]) != [INDEX_VERSION, stat.st_size, stat.st_mtime_ns]:
+        return build_index(path, supporting_answers)
+    if supporting_answers is not None and supporting_answers != bool(index[3]):
+        return build_index(path, supporting_answers)
+
+    return index[4:], bool(index[3])
+
+def parse_range(job):
+    """
+    Parses examples start to end of a file, job is a tuple of (path, offsets of the examples, supporting answers)
+    """
+
+    path, offsets, supporting_answers = job
+    with open(path, 'rb') as f:
+        f.seek(offsets[0])
+        data = f.read(offsets[-1] - offsets[0])
+    return parse(data, supporting_answers, [o - offsets[0] for o in offsets])
+
+class TextDataset:
+    """
+    Reads a text file written by countworld.examples_to_file, e.g. data/train.txt
+
+    The start of every example is kept in an index file next to it (path + '.idx'), which is built
+      the first time the file is read and whenever the file has changed, so dataset[i] only reads
+      and parses example i
+
+    dataset[i] gives example i in the same format as countworld.generate_examples
+    dataset.load() gives every example, parsed in chunks of chunk_size examples, by workers processes if workers > 0
+
+    supporting_answers (bool): if the file was generated with supporting_answers, which is stored in the index,
+                               guessed from the file if not given and not already in the index (see build_index)
+    """
+
+    def __init__(self, path, supporting_answers=None):
+
+        self.path = path
+        self.offsets, self.supporting_answers = load_index(path, supporting_answers)
+        self.file = open(path, 'rb')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        self.file.seek(self.offsets[i])
+        data = self.file.read(self.offsets[i+1] - self.offsets[i])
+        return parse_example(data.decode(), self.supporting_answers)
+
+    def chunks(self, chunk_size):
+        """
+        Jobs for parse_range, each with chunk_size examples
+        """
+
+        for start in range(0, len(self), chunk_size):
+            yield (self.path, self.offsets[start:start+chunk_size+1].tolist(), self.supporting_answers)
+
+    def __iter__(self):
+
+        for job in self.chunks(10_000):
+            yield from parse_range(job)
+
+    def load(self, workers=0, chunk_size=10_000):
+
+        if workers == 0:
+            return list(self)
+
+        #only imported here so importing loader (and cache) stays quick
+        import multiprocessing
+
+        examples = []
+        with multiprocessing.Pool(workers) as pool:
+            for chunk in pool.imap(parse_range, self.chunks(chunk_size)):
+                examples.extend(chunk)
+        return examples
+
+    def close(self):
+        self.file.close()
+
+def load(path, workers=0, chunk_size=10_000, supporting_answers=None):
+    """
+    Every example in the text file at path, see TextDataset
+    """
+
+    dataset = TextDataset(path, supporting_answers)
+    try:
+        return dataset.load(workers, chunk_size)
+    finally:
+        dataset.close()
@@ -0,0 +1,88 @@
+import json
+import time
+from collections import Counter
+
+#phases of generating and writing an example, in the order they happen
+PHASES = ['story', 'questions', 'filter', 'answers', 'write']
+
+class Profiler:
+    """
+    Times each phase of generating examples and counts what happens in them, pass it to
+      countworld.generate_examples (and countworld.examples_to_file) as profiler
+
+    The phases are:
+    - 'story': picking the entities/objects/locations and generating the sentences, which includes
+               updating the answer of every question affected by each sentence
+    - 'questions': listing (or drawing, with lazy_questions) the questions and checking their answers are in answer_values
+    - 'filter': shuffling the questions, keeping the ones the balancer wants and checking for duplicates
+    - 'answers': getting the supporting answers and turning the questions into strings
+    - 'write': turning the examples into lines and writing them to the file
+
+    The counts are:
+    - 'attempts' and 'examples'
+    - 'rejected_range', 'rejected_balance' and 'rejected_duplicate': attempts thrown away because too few questions
+      had answers in answer_values, too few were kept by the balancer, or the example was a duplicate
+    - 'questions_checked': questions whose answer was checked against answer_values
+    - 'questions_in_range': questions with answers in answer_values
+    - 'questions_refused': questions the balancer threw away
+    - 'questions_kept': questions in the examples generated
+    and actions has the number of each action in the stories of every attempt
+
+    Nothing is timed or counted when no profiler is given, and when one is, each phase is timed once per attempt,
+      not per sentence or question, so profiling adds very little time
+    """
+
+    def __init__(self):
+
+        self.times = Counter()
+        self.counts = Counter()
+        self.actions = Counter()
+        self.last = None
+        #cache entry the splits were served from instead of being generated, see cache.DatasetCache
+        self.served_from = None
+
+    def start(self):
+        """
+        Starts timing the next phase
+        """
+
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        Adds the time since start or the last lap to phase, and starts timing the next phase
+        """
+
+        now = time.perf_counter()
+        self.times[phase] += now - self.last
+        self.last = now
+
+    def update(self, other):
+        """
+        Adds the times and counts of another profiler, e.g. from another process
+        """
+
+        self.times.update(other.times)
+        self.counts.update(other.counts)
+        self.actions.update(other.actions)
+
+    def report(self):
+        """
+        Dict of the times, counts and actions, for printing or saving
+        The times are in seconds, summed over every process used
+        """
+
+        examples = max(self.counts['examples'], 1)
+        return {'times': {phase: self.times[phase] for phase in PHASES},
+                'seconds_per_example': {phase: self.times[phase] / examples for phase in PHASES},
+                'counts': dict(sorted(self.counts.items())),
+                'actions': dict(sorted(self.actions.items())),
+                'served_from': self.served_from}
+
+    def save(self, path):
+        """
+        Writes the report to path as json
+        """
+
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
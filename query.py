@@ -0,0 +1,238 @@
+import re
+import sys
+import bisect
+import functools
+import itertools
+import multiprocessing
+from collections import Counter, defaultdict
+
+import countworld
+
+#regexes that parse the sentences and questions made from the templates in countworld
+SENTENCE_PATTERNS = {action: re.compile(re.escape(template).replace(r'\{entity\}', '(?P<entity>.+?)')
+                                                            .replace(r'\{target\}', '(?P<target>.+?)')
+                                                            .replace(r'\{n\}', '(?P<n>[0-9]+)'))
+                     for action, template in countworld.SENTENCE_TEMPLATES.items()}
+QUESTION_PATTERNS = {family: re.compile(re.escape(template).replace(r'\{entity\}', '(?P<entity>.+?)')
+                                                           .replace(r'\{object\}', '(?P<object>.+?)')
+                                                           .replace(r'\{location\}', '(?P<location>.+?)'))
+                     for family, template in countworld.QUESTION_TEMPLATES.items()}
+
+#families whose answers generate_examples is known to give differently to what the question asks, see audit
+SUSPICIOUS_FAMILIES = (8, 13, 17)
+
+def parse_sentence(sentence):
+    """
+    (action, entity, location or object, number of objects) of a story sentence, the same as a structured sentence
+    """
+
+    for action, pattern in SENTENCE_PATTERNS.items():
+        match = pattern.fullmatch(sentence)
+        if match is not None:
+            return (action, match['entity'], match['target'], int(match.groupdict().get('n') or 0))
+    raise ValueError(f'could not parse sentence: {sentence}')
+
+#questions are repeated a lot, so the most recent ones are only parsed once
+@functools.lru_cache(maxsize=100_000)
+def parse_question(question):
+    """
+    (family, entity, object, location) of a question string, with None for what it doesn't ask about
+    """
+
+    for family, pattern in QUESTION_PATTERNS.items():
+        match = pattern.fullmatch(question)
+        if match is not None:
+            slots = match.groupdict()
+            return (family, slots.get('entity'), slots.get('object'), slots.get('location'))
+    raise ValueError(f'could not parse question: {question}')
+
+class StoryIndex:
+    """
+    Answers any question about a story, after any number of its sentences
+
+    The story is a list of sentences, either strings or structured tuples. Each question's answer
+      is kept as the sentences it changes at and its value after each change, so the answer after
+      any number of sentences is found with a binary search
+
+    The answers are what each question asks, which is not always what generate_examples gives:
+    - 8 and 13 are the number of different objects picked up from/dropped at the location, instead of
+      the number of locations the last object in the story's world was picked up from/dropped at
+    - 17 is the number of objects dropped, instead of the number of times they were dropped (question 16)
+    """
+
+    def __init__(self, story):
+
+        self.events = [parse_sentence(s) if isinstance(s, str) else tuple(s) for s in story]
+
+        #{(family, entity, object, location): ([sentences], [values])}, the current value is the last one
+        self.changes = changes = {}
+
+        def add(step, key, amount):
+            if key not in changes:
+                changes[key] = ([step], [amount])
+                return
+            steps, values = changes[key]
+            if steps[-1] == step:
+                values[-1] += amount
+            else:
+                steps.append(step)
+                values.append(values[-1] + amount)
+
+        #the times counters only go up, so a question is 0 if it hasn't changed yet
+        position = {}
+        for step, (action, entity, target, n) in enumerate(self.events, 1):
+
+            if action == 'move':
+                location = position[entity] = target
+                if (19, entity, None, location) not in changes:
+                    add(step, (18, None, None, location), 1)
+                add(step, (19, entity, None, location), 1)
+                add(step, (20, None, None, location), 1)
+                continue
+
+            obj, location = target, position[entity]
+            if action == 'pick':
+                carried, entities, times, total, objects, times_location, total_location, times_entity, total_entity = n, 2, 3, 4, 8, 9, 10, 11, 12
+            else:
+                carried, entities, times, total, objects, times_location, total_location, times_entity, total_entity = -n, 5, 6, 7, 13, 14, 15, 16, 17
+
+            if (times_entity, entity, obj, None) not in changes:
+                add(step, (entities, None, obj, None), 1)
+            if (times_location, None, obj, location) not in changes:
+                add(step, (objects, None, None, location), 1)
+            add(step, (1, entity, obj, None), carried)
+            add(step, (times, None, obj, None), 1)
+            add(step, (total, None, obj, None), n)
+            add(step, (times_location, None, obj, location), 1)
+            add(step, (total_location, None, obj, location), n)
+            add(step, (times_entity, entity, obj, None), 1)
+            add(step, (total_entity, entity, obj, None), n)
+
+    def __len__(self):
+        return len(self.events)
+
+    def answer(self, question, step=None):
+        """
+        Answer to question after step sentences, or the whole story if step is None
+        question can be a question string or (family, entity, object, location) tuple of names
+        """
+
+        if isinstance(question, str):
+            question = parse_question(question)
+        if step is None:
+            step = len(self.events)
+
+        if question not in self.changes:
+            return 0
+        steps, values = self.changes[question]
+        i = bisect.bisect_right(steps, step)
+        return values[i-1] if i > 0 else 0
+
+    def answers(self, question):
+        """
+        Answer to question after each sentence, the same as a supporting answer
+        """
+
+        if isinstance(question, str):
+            question = parse_question(question)
+
+        answers = [0] * len(self.events)
+        if question in self.changes:
+            steps, values = self.changes[question]
+            for i, (step, value) in enumerate(zip(steps, values)):
+                end = steps[i+1] if i + 1 < len(steps) else len(self.events) + 1
+                answers[step-1:end-1] = [value] * (end - step)
+        return answers
+
+def score_chunk(job, labels='dataset'):
+    """
+    score for a list of (example, predictions), used by score to split the work between processes
+    """
+
+    counts = Counter()
+    for example, predicted in job:
+        index = StoryIndex(example['story']) if labels == 'intended' else None
+        for (question, answer), prediction in zip(example['questions'], predicted):
+            question = parse_question(question)
+            if index is not None:
+                answer = index.answers(question) if isinstance(prediction, list) else index.answer(question)
+            correct = prediction == answer
+            counts['total'] += 1
+            counts['correct'] += correct
+            counts[(question[0], 'total')] += 1
+            counts[(question[0], 'correct')] += correct
+    return counts
+
+def score(examples, predictions, workers=0, chunk_size=10_000, labels='dataset'):
+    """
+    Checks predicted answers against the answers of each question in the examples, examples are in
+      the same format as generate_examples (e.g. from loader.TextDataset) and predictions has a list
+      of answers for each example, one per question, with a list per question for supporting answers
+    labels (str): 'dataset' checks against the answers in the examples, which is what a model is trained on,
+                  'intended' against the answers from StoryIndex, which differ for the SUSPICIOUS_FAMILIES
+    If workers > 0, chunks of chunk_size examples are scored by a pool of workers processes
+    Returns a Counter of 'correct' and 'total', and the same for each family as (family, 'correct') and (family, 'total')
+    """
+
+    assert labels in ('dataset', 'intended'), f'unknown labels: {labels}'
+
+    pairs = zip(examples, predictions)
+    if workers == 0:
+        return score_chunk(pairs, labels)
+
+    jobs = iter(lambda: list(itertools.islice(pairs, chunk_size)), [])
+    counts = Counter()
+    with multiprocessing.Pool(workers) as pool:
+        for chunk_counts in pool.imap(functools.partial(score_chunk, labels=labels), jobs):
+            counts.update(chunk_counts)
+    return counts
+
+def audit(examples):
+    """
+    Compares the answers in the examples to what each question asks, for each family counts:
+    - 'total': questions of that family
+    - 'match': answers that are what the question asks
+    - 'legacy': answers that are what generate_examples is known to give instead, for 8 and 13 the number
+                of locations some object was picked up from/dropped at, for 17 the answer to question 16
+    """
+
+    counts = defaultdict(Counter)
+    for example in examples:
+        index = StoryIndex(example['story'])
+        objects = {target for action, _, target, _ in index.events if action != 'move'}
+        for question, answer in example['questions']:
+            family, entity, obj, location = question = parse_question(question)
+            expected = index.answers(question) if isinstance(answer, list) else index.answer(question)
+            counts[family]['total'] += 1
+            counts[family]['match'] += answer == expected
+
+            if family in (8, 13):
+                #number of different locations each object was picked up from/dropped at
+                times_location = 9 if family == 8 else 14
+                legacy = [sum(1 for (f, _, o, _) in index.changes if f == times_location and o == other) for other in objects]
+                if isinstance(answer, list):
+                    #the last object is the same for the whole story, but may not have been picked/dropped yet
+                    counts[family]['legacy'] += answer[-1] in legacy + [0]
+                else:
+                    counts[family]['legacy'] += answer in legacy + [0]
+            elif family == 17:
+                legacy_question = (16, entity, obj, location)
+                legacy = index.answers(legacy_question) if isinstance(answer, list) else index.answer(legacy_question)
+                counts[family]['legacy'] += answer == legacy
+
+    return counts
+
+if __name__ == '__main__':
+
+    #python query.py data/test.txt audits the answers in a file written by generate.py
+    import loader
+
+    for path in sys.argv[1:]:
+        counts = audit(loader.TextDataset(path))
+        print(path)
+        for family in sorted(counts):
+            c = counts[family]
+            line = f"  {family:2d} {countworld.QUESTION_TEMPLATES[family]:<70} {c['match']}/{c['total']} match"
+            if family in SUSPICIOUS_FAMILIES:
+                line += f", {c['legacy']}/{c['total']} match the known bug"
+            print(line)
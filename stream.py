@@ -0,0 +1,167 @@
+import queue
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+
+import countworld
+from vocab import Vocab
+
+#torch is optional, when it is installed the dataset can be used with a torch DataLoader
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset = object
+    get_worker_info = lambda: None
+
+def generate_chunk(job, vocab, sequences=False):
+    """
+    Generates the examples for a single chunk as ids from vocab, job is the same as for countworld.generate_shard
+    The examples are rows of ids (see Vocab.rows), or token id sequences (see Vocab.encode) if sequences is True
+    """
+
+    examples, _, _ = countworld.generate_shard(job)
+    encode = vocab.encode if sequences else vocab.rows
+    return [encode(ex) for ex in examples]
+
+class StreamDataset(IterableDataset):
+    """
+    Endless stream of examples as ids, generated as they are used instead of read from a file, each is a dict of
+      'story', 'questions' and 'answers' in the same layout as binary.BinaryWriter stores (see Vocab.rows)
+
+    Takes the same arguments as countworld.iter_examples, except n_examples, plus:
+    chunk_size (int): number of examples generated at once
+    prefetch (int): number of chunks generated ahead of the examples being used
+    processes (int): if 0, chunks are generated by a background thread, otherwise by a pool of processes
+    shard (int), n_shards (int): splits the stream into n_shards streams with different examples, e.g. one
+                                 for each process when training on multiple GPUs
+    vocab (vocab.Vocab): vocab the ids are from, the built in names if not given
+    sequences (bool): if True, each sentence and question is its token id sequence from vocab (see Vocab.encode)
+                      instead of a row
+
+    The stream is split in the same way between the workers of a torch DataLoader. Each chunk has its own
+      random number generator seeded from random_seed, the chunk index and which stream it is in, so the
+      stream is the same every time it is iterated for the same random_seed, shard and number of workers
+    """
+
+    def __init__(self,
+                 n_entities,
+                 n_objects,
+                 n_locations,
+                 story_length,
+                 n_questions,
+                 which_questions,
+                 answer_values,
+                 supporting_answers,
+                 pick_max,
+                 random_seed=None,
+                 lazy_questions=False,
+                 max_attempts=1000,
+                 steer=False,
+                 chunk_size=64,
+                 prefetch=16,
+                 processes=0,
+                 shard=0,
+                 n_shards=1,
+                 vocab=None,
+                 sequences=False):
+
+        assert chunk_size > 0
+        assert prefetch > 0
+        assert processes >= 0
+        assert 0 <= shard < n_shards
+
+        #check the arguments here instead of when the first chunk is generated
+        next(countworld.iter_examples(1, n_entities, n_objects, n_locations, story_length, n_questions, which_questions,
+                                      answer_values, supporting_answers, pick_max, rng=countworld.shard_rng(random_seed, -1),
+                                      progress=False, max_attempts=max_attempts, steer=steer, structured=True))
+
+        self.kwargs = {'n_entities': n_entities,
+                       'n_objects': n_objects,
+                       'n_locations': n_locations,
+                       'story_length': story_length,
+                       'n_questions': n_questions,
+                       'which_questions': which_questions,
+                       'answer_values': answer_values,
+                       'supporting_answers': supporting_answers,
+                       'pick_max': pick_max,
+                       'lazy_questions': lazy_questions,
+                       'max_attempts': max_attempts,
+                       'steer': steer,
+                       'structured': True}
+        self.vocab = Vocab() if vocab is None else vocab
+        self.sequences = sequences
+        self.random_seed = random_seed
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.processes = processes
+        self.shard = shard
+        self.n_shards = n_shards
+
+    def jobs(self):
+        """
+        Endless jobs for generate_chunk, the chunks of this stream are every n_streams-th chunk of the whole stream
+        """
+
+        worker = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        stream = self.shard * n_workers + worker_id
+        n_streams = self.n_shards * n_workers
+
+        for chunk in itertools.count():
+            yield (chunk * n_streams + stream, self.chunk_size, self.random_seed, self.kwargs)
+
+    def __iter__(self):
+
+        if self.processes > 0:
+            chunks = self.iter_processes()
+        else:
+            chunks = self.iter_thread()
+
+        for chunk in chunks:
+            yield from chunk
+
+    def iter_processes(self):
+
+        with multiprocessing.Pool(self.processes) as pool:
+
+            #chunks being generated, in order
+            pending = deque()
+
+            for job in self.jobs():
+                pending.append(pool.apply_async(generate_chunk, (job, self.vocab, self.sequences)))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().get()
+
+    def iter_thread(self):
+
+        chunks = queue.Queue(self.prefetch)
+        stop = threading.Event()
+
+        def fill():
+            try:
+                for job in self.jobs():
+                    chunk = generate_chunk(job, self.vocab, self.sequences)
+                    #don't block forever once the stream is no longer being used
+                    while not stop.is_set():
+                        try:
+                            chunks.put(chunk, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                chunks.put(e)
+
+        thread = threading.Thread(target=fill, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                chunk = chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
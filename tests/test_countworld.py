@@ -0,0 +1,292 @@
+import os
+import gzip
+import json
+import random
+import itertools
+import threading
+import collections
+
+import pytest
+
+import countworld
+
+#examples made by generate_examples in the first version of countworld.py, for each of CONFIGS
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_examples.json')
+
+ALL_QUESTIONS = set(range(1, 21))
+INF = float('inf')
+
+CONFIGS = {'default': dict(n_entities=(2, 2), n_objects=(2, 2), n_locations=(2, 2), story_length=(10, 10), n_questions=(1, 1),
+                           which_questions=ALL_QUESTIONS, answer_values=(-INF, INF), supporting_answers=False, pick_max=3, random_seed=1234),
+           'supporting': dict(n_entities=(1, 3), n_objects=(1, 3), n_locations=(1, 3), story_length=(5, 15), n_questions=(1, 3),
+                              which_questions=ALL_QUESTIONS, answer_values=(-INF, INF), supporting_answers=True, pick_max=2, random_seed=7),
+           'ranged': dict(n_entities=(2, 4), n_objects=(2, 4), n_locations=(2, 4), story_length=(10, 20), n_questions=(2, 4),
+                          which_questions={1, 2, 3, 8, 13, 16, 17}, answer_values=(0, 5), supporting_answers=False, pick_max=3, random_seed=99)}
+
+#generate_examples shuffles the name lists in place, so each test starts from the original order
+NAMES = [list(names) for names in (countworld.ENTITY_NAMES, countworld.OBJECT_NAMES, countworld.LOCATION_NAMES)]
+
+@pytest.fixture(autouse=True)
+def original_names():
+    countworld.ENTITY_NAMES[:], countworld.OBJECT_NAMES[:], countworld.LOCATION_NAMES[:] = [list(names) for names in NAMES]
+
+#questions 8 and 13 are answered for the last object of the generator's list (see README), which the example doesn't say
+REPLAYED_QUESTIONS = ALL_QUESTIONS - {8, 13}
+
+def replay(example, supporting_answers):
+    """
+    (answer, answer worked out by applying each sentence of the story to a new AnswerTracker) for each question
+      of a structured example in REPLAYED_QUESTIONS
+    """
+
+    entities, objects, locations = [], [], []
+    for action, entity, target, _ in example['story']:
+        for names, name in ((entities, entity), (locations if action == 'move' else objects, target)):
+            if name not in names:
+                names.append(name)
+    for (_, entity, obj, location), _ in example['questions']:
+        for names, name in ((entities, entity), (objects, obj), (locations, location)):
+            if name is not None and name not in names:
+                names.append(name)
+
+    questions = [(family,
+                  None if entity is None else entities.index(entity),
+                  None if obj is None else objects.index(obj),
+                  None if location is None else locations.index(location)) for (family, entity, obj, location), _ in example['questions']]
+
+    tracker = countworld.AnswerTracker(entities, objects, locations, supporting_answers)
+    positions = {}
+    answers = [[] for _ in questions]
+    for action, entity, target, n in example['story']:
+        e = entities.index(entity)
+        if action == 'move':
+            positions[e] = locations.index(target)
+            tracker.apply('move', e, None, positions[e], 0)
+        else:
+            tracker.apply(action, e, objects.index(target), positions[e], n)
+        for question, answer in zip(questions, answers):
+            answer.append(tracker.answer(question))
+
+    return [(answer, replayed if supporting_answers else replayed[-1])
+            for ((family, _, _, _), answer), replayed in zip(example['questions'], answers) if family in REPLAYED_QUESTIONS]
+
+@pytest.mark.parametrize('name', sorted(CONFIGS))
+def test_same_examples_as_baseline(name):
+
+    with open(BASELINE) as f:
+        expected = json.load(f)[name]
+
+    examples = countworld.generate_examples(len(expected), **CONFIGS[name], progress=False)
+
+    #json turns the (question, answer) tuples into lists
+    examples = json.loads(json.dumps(examples))
+    assert examples == expected
+
+@pytest.mark.parametrize('name', sorted(CONFIGS))
+def test_structured_answers_match_replay(name):
+
+    config = CONFIGS[name]
+    for example in countworld.generate_examples(50, **config, progress=False, structured=True):
+        for answer, replayed in replay(example, config['supporting_answers']):
+            assert answer == replayed
+
+@pytest.mark.parametrize('name', sorted(CONFIGS))
+def test_batch_answers_match_replay(name):
+
+    batch = pytest.importorskip('batch')
+
+    config = dict(CONFIGS[name])
+    random_seed = config.pop('random_seed')
+    low, high = config['answer_values']
+    for example in batch.iter_examples(50, **config, random_seed=random_seed, batch_size=16, structured=True):
+        for answer, replayed in replay(example, config['supporting_answers']):
+            assert answer == replayed
+        for _, answer in example['questions']:
+            values = answer if config['supporting_answers'] else [answer]
+            assert low <= min(values) and max(values) <= high
+
+def structured_examples(n, random_seed=0):
+    config = dict(CONFIGS['supporting'], random_seed=random_seed)
+    return countworld.generate_examples(n, **config, progress=False, structured=True)
+
+def failing(examples, n):
+    """
+    The first n of examples, then raises
+    """
+
+    yield from examples[:n]
+    raise RuntimeError('generation failed')
+
+def test_binary_round_trip(tmp_path):
+
+    binary = pytest.importorskip('binary')
+
+    examples = structured_examples(30)
+    countworld.examples_to_file('train', examples, binary_file=True, data_dir=str(tmp_path))
+
+    dataset = binary.BinaryDataset(str(tmp_path / 'train.cwb'))
+    assert len(dataset) == len(examples)
+    assert [dataset.decode(i) for i in range(len(dataset))] == [countworld.example_to_text(ex) for ex in examples]
+    dataset.close()
+
+    with open(tmp_path / 'train.txt') as f:
+        assert f.read() == ''.join(countworld.example_to_string(countworld.example_to_text(ex)) for ex in examples)
+
+def test_failed_binary_write_leaves_files(tmp_path):
+
+    countworld.examples_to_file('train', structured_examples(30), binary_file=True, data_dir=str(tmp_path))
+    before = {path.name: path.read_bytes() for path in tmp_path.iterdir()}
+
+    with pytest.raises(RuntimeError):
+        countworld.examples_to_file('train', failing(structured_examples(30, random_seed=1), 10), binary_file=True, data_dir=str(tmp_path))
+
+    assert {path.name: path.read_bytes() for path in tmp_path.iterdir()} == before
+
+def test_batch_stats_count_stories_used():
+
+    batch = pytest.importorskip('batch')
+
+    config = dict(CONFIGS['ranged'])
+    random_seed = config.pop('random_seed')
+    stats = collections.Counter()
+    examples = list(batch.iter_examples(10, **dict(config, answer_values=(3, 5)), random_seed=random_seed, batch_size=1024, stats=stats))
+    assert stats['examples'] == len(examples) == 10
+    assert stats['attempts'] == stats['examples'] + stats['rejected'] < 1024
+
+    #max_attempts counts stories in a row, not batches
+    with pytest.raises(ValueError, match='after 1000 attempts'):
+        list(batch.iter_examples(1, **dict(config, answer_values=(1000, 2000)), random_seed=random_seed, batch_size=4096))
+
+def test_score_dataset_labels():
+
+    query = pytest.importorskip('query')
+
+    examples = countworld.generate_examples(50, **CONFIGS['ranged'], progress=False)
+    predictions = [[answer for _, answer in example['questions']] for example in examples]
+
+    #the answers a model is trained on are all correct, even for the families StoryIndex answers differently
+    counts = query.score(examples, predictions)
+    assert counts['correct'] == counts['total'] > 0
+
+    counts = query.score(examples, predictions, labels='intended')
+    assert counts['correct'] <= counts['total']
+    for family in set(CONFIGS['ranged']['which_questions']) - set(query.SUSPICIOUS_FAMILIES):
+        assert counts[(family, 'correct')] == counts[(family, 'total')]
+
+def test_loader_supporting_answers_of_one_sentence_stories(tmp_path):
+
+    loader = pytest.importorskip('loader')
+
+    config = dict(CONFIGS['supporting'], story_length=(1, 1), n_questions=(1, 1))
+    examples = countworld.generate_examples(20, **config, progress=False)
+    countworld.examples_to_file('train', examples, data_dir=str(tmp_path))
+    path = str(tmp_path / 'train.txt')
+
+    #every answer line has a single answer, so without being told the answers look like plain answers
+    assert loader.load(path)[0]['questions'][0][1] == examples[0]['questions'][0][1][0]
+
+    #once given, the flag is kept in the index
+    assert loader.load(path, supporting_answers=True) == examples
+    assert loader.TextDataset(path).supporting_answers
+
+@pytest.mark.parametrize('n_names', [3, 100])
+def test_in_range_questions_match_every_question(n_names):
+
+    rng = random.Random(n_names)
+    names = [[f'{kind}{i}' for i in range(n_names)] for kind in 'eol']
+    for supporting_answers in (False, True):
+        tracker = countworld.AnswerTracker(*names, supporting_answers)
+        positions = {}
+        for _ in range(30):
+            e = rng.randrange(3)
+            if e not in positions or rng.random() < 0.3:
+                positions[e] = rng.randrange(3)
+                tracker.apply('move', e, None, positions[e], 0)
+            else:
+                tracker.apply(rng.choice(['pick', 'drop']), e, rng.randrange(3), positions[e], rng.randint(1, 3))
+
+        #100 of each name is enough for the counters to be sparse, where only the changed ones are checked
+        counts = tracker.question_counts(ALL_QUESTIONS)
+        every_question = tracker.questions(ALL_QUESTIONS)
+        for answer_values in ((1, INF), (-INF, 0)):
+            questions, _ = tracker.in_range_questions(counts, answer_values, set())
+            assert sorted(questions) == [q for q in sorted(every_question) if tracker.in_range(q, answer_values)]
+
+def run_generate(data_dir, **kwargs):
+    """
+    Runs generate.py with kwargs and returns what generate.main does, with the contents of each split it wrote as 'splits'
+    """
+
+    generate = pytest.importorskip('generate')
+
+    result = generate.main(generate.config(data_dir=str(data_dir), no_progress=True, **kwargs))
+    result['splits'] = {}
+    for name, path in result['paths'].items():
+        with open(path, 'rb') as f:
+            result['splits'][name] = f.read()
+    return result
+
+SMALL_SPLITS = dict(n_train_examples=60, n_valid_examples=25, n_test_examples=25)
+
+def test_resumed_checkpoint_matches_uninterrupted(tmp_path, monkeypatch):
+
+    expected = run_generate(tmp_path / 'fresh', **SMALL_SPLITS)['splits']
+
+    #stop generating part way through the valid split
+    iter_examples = countworld.iter_examples
+    def interrupted(*args, **kwargs):
+        yield from itertools.islice(iter_examples(*args, **kwargs), 70)
+        raise KeyboardInterrupt
+    monkeypatch.setattr(countworld, 'iter_examples', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run_generate(tmp_path / 'resumed', checkpoint_size=8, **SMALL_SPLITS)
+    monkeypatch.undo()
+    assert os.path.exists(tmp_path / 'resumed' / 'checkpoint' / 'manifest.json')
+
+    assert run_generate(tmp_path / 'resumed', checkpoint_size=8, **SMALL_SPLITS)['splits'] == expected
+    assert not os.path.exists(tmp_path / 'resumed' / 'checkpoint')
+
+@pytest.mark.parametrize('splits', [SMALL_SPLITS, dict(n_train_examples=40, n_valid_examples=30, n_test_examples=10)])
+def test_cache_serves_same_as_fresh(tmp_path, splits):
+
+    pytest.importorskip('cache')
+
+    cache_dir = str(tmp_path / 'cache')
+    stored = run_generate(tmp_path / 'stored', cache_dir=cache_dir, **SMALL_SPLITS)
+    assert not stored['cached']
+    assert stored['splits'] == run_generate(tmp_path / 'fresh', **SMALL_SPLITS)['splits']
+
+    served = run_generate(tmp_path / 'served', cache_dir=cache_dir, **splits)
+    assert served['cached']
+    assert served['splits'] == run_generate(tmp_path / 'expected', **splits)['splits']
+
+def test_gzip_splits_match_text(tmp_path):
+
+    writers = pytest.importorskip('writers')
+
+    splits = [('train', 30), ('valid', 10)]
+    examples = countworld.generate_examples(40, **CONFIGS['default'], progress=False)
+    writers.write_splits(splits, iter(examples), str(tmp_path), compression='gzip', batch_size=7)
+
+    start = 0
+    for name, n_examples in splits:
+        with gzip.open(tmp_path / f'{name}.txt.gz', 'rt') as f:
+            assert f.read() == ''.join(countworld.example_to_string(ex) for ex in examples[start:start + n_examples])
+        start += n_examples
+
+def test_failed_write_splits_leaves_files(tmp_path):
+
+    writers = pytest.importorskip('writers')
+
+    splits = [('train', 30), ('valid', 10)]
+    writers.write_splits(splits, iter(countworld.generate_examples(40, **CONFIGS['default'], progress=False)), str(tmp_path), compression='gzip')
+    before = {path.name: path.read_bytes() for path in tmp_path.iterdir()}
+    threads = threading.active_count()
+
+    #fails part way through the valid split, after train has been written
+    examples = countworld.generate_examples(40, **dict(CONFIGS['default'], random_seed=1), progress=False)
+    with pytest.raises(RuntimeError):
+        writers.write_splits(splits, failing(examples, 35), str(tmp_path), compression='gzip', batch_size=4)
+
+    assert {path.name: path.read_bytes() for path in tmp_path.iterdir()} == before
+    assert threading.active_count() == threads
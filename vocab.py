@@ -0,0 +1,137 @@
+import countworld
+
+#tokens that aren't words of the templates, names or numbers
+SPECIAL_TOKENS = ['<pad>', '<sos>', '<eos>']
+
+class Vocab:
+    """
+    Fixed vocab of every token that can appear in a story or question, so examples can be made
+      straight into token ids without making strings, pass it to countworld.generate_examples as vocab
+
+    The tokens are the SPECIAL_TOKENS, the words of the sentence and question templates, the sorted entity,
+      object and location names and the numbers 0 to max_number, in that order, so the ids only
+      change if the templates or names do
+    The names also have ids within their kind, which is what rows and binary files use
+
+    Each template is turned into its token ids once, with the names and numbers filled in when it is used
+    """
+
+    def __init__(self, entity_names=None, object_names=None, location_names=None, max_number=999):
+
+        #names are sorted, so the ids don't depend on the module lists being shuffled
+        self.entity_names = sorted(set(entity_names or countworld.ENTITY_NAMES))
+        self.object_names = sorted(set(object_names or countworld.OBJECT_NAMES))
+        self.location_names = sorted(set(location_names or countworld.LOCATION_NAMES))
+        self.max_number = max_number
+
+        #names of each kind and the id of each name within its kind, used for rows
+        self.names = {'entities': self.entity_names, 'objects': self.object_names, 'locations': self.location_names}
+        self.name_ids = {kind: {name: i for i, name in enumerate(names)} for kind, names in self.names.items()}
+
+        templates = list(countworld.SENTENCE_TEMPLATES.values()) + list(countworld.QUESTION_TEMPLATES.values())
+        words = []
+        for template in templates:
+            for word in template.split():
+                if not word.startswith('{') and word not in words:
+                    words.append(word)
+
+        self.tokens = SPECIAL_TOKENS + words
+        seen = set(self.tokens) #so large name pools don't search the whole list for each name
+        for name in self.entity_names + self.object_names + self.location_names:
+            assert ' ' not in name, f'names have to be a single token: {name}'
+            if name not in seen:
+                seen.add(name)
+                self.tokens.append(name)
+        self.number_offset = len(self.tokens)
+        self.tokens += [str(n) for n in range(max_number + 1)]
+        self.ids = {token: i for i, token in enumerate(self.tokens)}
+
+        #each template as (token ids with 0 where a slot goes, [(position, slot name)])
+        self.sentence_templates = {action: self.compile(template) for action, template in countworld.SENTENCE_TEMPLATES.items()}
+        self.question_templates = {family: self.compile(template) for family, template in countworld.QUESTION_TEMPLATES.items()}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def compile(self, template):
+
+        ids = []
+        slots = []
+        for position, word in enumerate(template.split()):
+            if word.startswith('{'):
+                ids.append(0)
+                slots.append((position, word[1:-1]))
+            else:
+                ids.append(self.ids[word])
+        return ids, slots
+
+    def number(self, n):
+
+        if not 0 <= n <= self.max_number:
+            raise ValueError(f'{n} is not in the vocab, use a larger max_number')
+        return self.number_offset + n
+
+    def rows(self, example):
+        """
+        Turns an example generated with structured=True into rows of ids, the layout binary.BinaryWriter stores:
+        - 'story' is a list of [action, entity, location or object, number of objects] for each sentence
+        - 'questions' is a list of [question family, entity, object, location] for each question, -1 for unused slots
+        - 'answers' is a list of the answer to each question, which is a list if there are supporting answers
+        The actions are ids in countworld.ACTIONS and the names ids in names of their kind
+        """
+
+        entities, objects, locations = self.name_ids['entities'], self.name_ids['objects'], self.name_ids['locations']
+
+        story = []
+        for action, entity, target, n in example['story']:
+            story.append([countworld.ACTIONS.index(action), entities[entity], locations[target] if action == 'move' else objects[target], n])
+
+        questions = []
+        answers = []
+        for (family, entity, obj, location), answer in example['questions']:
+            questions.append([family,
+                              -1 if entity is None else entities[entity],
+                              -1 if obj is None else objects[obj],
+                              -1 if location is None else locations[location]])
+            answers.append(answer)
+
+        return {'story': story, 'questions': questions, 'answers': answers}
+
+    def encode(self, example):
+        """
+        Turns an example generated with structured=True into token ids, with the same keys as rows:
+          'story' is a list of the token ids of each sentence, 'questions' a list of the token ids of each
+          question and 'answers' a list of the answer to each question
+        """
+
+        ids = self.ids
+
+        story = []
+        for action, entity, target, n in example['story']:
+            template, slots = self.sentence_templates[action]
+            sentence = template.copy()
+            for position, slot in slots:
+                if slot == 'n':
+                    sentence[position] = self.number(n)
+                else:
+                    sentence[position] = ids[entity if slot == 'entity' else target]
+            story.append(sentence)
+
+        questions = []
+        answers = []
+        for (family, entity, obj, location), answer in example['questions']:
+            template, slots = self.question_templates[family]
+            question = template.copy()
+            for position, slot in slots:
+                question[position] = ids[entity if slot == 'entity' else obj if slot == 'object' else location]
+            questions.append(question)
+            answers.append(answer)
+
+        return {'story': story, 'questions': questions, 'answers': answers}
+
+    def decode(self, ids):
+        """
+        The string a list of token ids is made from
+        """
+
+        return ' '.join(self.tokens[i] for i in ids)
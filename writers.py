@@ -0,0 +1,177 @@
+import os
+import gzip
+import time
+import queue
+import itertools
+import threading
+
+import countworld
+
+#extension added to the file name for each compression
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+def open_compressed(f, compression=None, level=None):
+    """
+    File object that compresses what is written to it with compression ('gzip', 'zstd' or None) and writes it to f,
+      closing it doesn't close f
+    gzip files are written without a timestamp, so the same examples always give the same file
+    zstd needs the zstandard package
+    """
+
+    if compression is None:
+        return f
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6 if level is None else level, mtime=0)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression needs the zstandard package, install it with pip install zstandard')
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(f, closefd=False)
+    raise ValueError(f'unknown compression: {compression}')
+
+class SplitWriter(threading.Thread):
+    """
+    Writes batches of text to path in its own thread, compressed with compression, so compressing and writing
+      a split happens at the same time as generating the examples (of this split or the next one)
+    At most max_pending batches wait to be written, so memory doesn't depend on how far ahead generation gets
+    The file is written to a temporary file which only replaces path when replace is called, once every batch
+      is written, so path never has part of a split
+    """
+
+    def __init__(self, path, compression=None, level=None, max_pending=8):
+
+        super().__init__(daemon=True)
+        self.path = path
+
+        #opened here so a missing compression package is raised straight away
+        self.raw = open(path + '.tmp', 'wb')
+        try:
+            self.file = open_compressed(self.raw, compression, level)
+        except Exception:
+            self.raw.close()
+            os.remove(path + '.tmp')
+            raise
+
+        self.batches = queue.Queue(max_pending)
+        self.closed = False
+        self.error = None
+        self.seconds = 0 #time spent compressing and writing
+        self.start()
+
+    def run(self):
+
+        finished = False
+        try:
+            with self.raw as raw:
+                f = self.file
+                while True:
+                    text = self.batches.get()
+                    if text is None:
+                        finished = True
+                        break
+                    start = time.perf_counter()
+                    f.write(text.encode())
+                    self.seconds += time.perf_counter() - start
+                if f is not raw:
+                    f.close()
+        except BaseException as e:
+            self.error = e
+            #keep taking batches, so write never waits forever for space in the queue
+            while not finished:
+                finished = self.batches.get() is None
+
+    def write(self, text):
+        """
+        Adds text to the end of the file
+        """
+
+        if self.error is not None:
+            raise self.error
+        self.batches.put(text)
+
+    def close(self):
+        """
+        Finishes the file once everything written so far has been, without waiting for it
+        """
+
+        if not self.closed:
+            self.closed = True
+            self.batches.put(None)
+
+    def wait(self):
+        """
+        Waits for the file to be finished, raising any error from writing it
+        """
+
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def replace(self):
+        """
+        Replaces path with the finished file, call after wait
+        """
+
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        """
+        Stops the thread once it has written what it has been given so far and removes the temporary file, leaving path as it was
+        """
+
+        self.close()
+        self.join()
+        if os.path.exists(self.path + '.tmp'):
+            os.remove(self.path + '.tmp')
+
+def write_splits(splits, examples, data_dir='data', compression=None, level=None, batch_size=1000, profiler=None, on_split=None):
+    """
+    Writes the examples to {data_dir}/{name}.txt for each (name, number of examples) in splits, taking each
+      split's examples in order from examples, the same files as examples_to_file for each split but compressed
+      with compression ('gzip' adds .gz to the file name, 'zstd' adds .zst)
+
+    The lines of batch_size examples are put together into a single string, which is compressed and written
+      by the split's SplitWriter thread, so the splits are compressed and written at the same time as the
+      examples are generated, and each split carries on being written while the next is generated
+
+    profiler (profiling.Profiler): if given, the time spent putting together the lines and compressing
+                                   and writing them is added to its 'write' phase
+    on_split (callable): called with the name of each split once all of its examples have been generated,
+                         before it has finished being written
+    """
+
+    os.makedirs(data_dir, exist_ok=True)
+
+    writers = []
+    try:
+        for name, n_examples in splits:
+
+            writer = SplitWriter(os.path.join(data_dir, f'{name}.txt{EXTENSIONS[compression]}'), compression, level)
+            writers.append(writer)
+
+            split = itertools.islice(examples, n_examples)
+            for batch in iter(lambda: list(itertools.islice(split, batch_size)), []):
+                if profiler is not None:
+                    profiler.start()
+                writer.write(''.join([countworld.example_to_string(ex) for ex in batch]))
+                if profiler is not None:
+                    profiler.lap('write')
+
+            writer.close()
+            if on_split is not None:
+                on_split(name)
+
+        for writer in writers:
+            writer.wait()
+    except BaseException:
+        #stop every thread and remove the temporary files, so a failed run leaves no threads or files behind
+        for writer in writers:
+            writer.abort()
+        raise
+
+    #the files are only replaced once every split has been written, so if generation fails none of them are
+    for writer in writers:
+        writer.replace()
+        if profiler is not None:
+            profiler.times['write'] += writer.seconds